@@ -0,0 +1,83 @@
+#
+# <license>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+# 
+# 
+# Copyright 2013 Sapphire Open Systems
+#  
+# </license>
+#
+
+# Compares encode/decode cost per object and per event for each
+# available wire codec.
+#
+# usage: python codec_benchmark.py [count]
+
+import sys
+import time
+from datetime import datetime
+
+from sapphire.core import KVObject, KVEvent
+from sapphire.core import json_codec
+
+
+def bench(name, fn, count):
+    start = time.time()
+
+    for i in xrange(count):
+        fn()
+
+    elapsed = time.time() - start
+
+    print "%-40s %8.2f us/op" % (name, (elapsed / count) * 1000000.0)
+
+
+def run(count):
+    obj = KVObject(collection="sensors", 
+                   name="sensor_0", 
+                   temperature=21.5, 
+                   humidity=40, 
+                   enabled=True)
+
+    event = KVEvent(key="temperature", 
+                    value=21.5, 
+                    timestamp=datetime.utcnow(), 
+                    object_id=obj.object_id)
+
+    for name in sorted(json_codec.available_codecs()):
+        codec = json_codec.get_codec(name)
+
+        obj_msg = {"method": "publish", "origin_id": obj.origin_id, "data": obj}
+        event_msg = {"method": "events", "origin_id": obj.origin_id, "data": [event]}
+
+        obj_data = codec.encode(obj_msg)
+        event_data = codec.encode(event_msg)
+
+        print "%s: object %d bytes, event %d bytes" % (name, len(obj_data), len(event_data))
+
+        bench("%s encode object" % (name), lambda: codec.encode(obj_msg), count)
+        bench("%s decode object" % (name), 
+              lambda: KVObject().from_dict(json_codec.decode(obj_data)["data"]), count)
+        bench("%s encode event" % (name), lambda: codec.encode(event_msg), count)
+        bench("%s decode event" % (name), 
+              lambda: KVEvent().from_dict(json_codec.decode(event_data)["data"][0]), count)
+
+    ts = datetime.utcnow().isoformat()
+
+    bench("strptime timestamp", 
+          lambda: datetime.strptime(ts, "%Y-%m-%dT%H:%M:%S.%f"), count)
+    bench("decode_timestamp isoformat", 
+          lambda: json_codec.decode_timestamp(ts), count)
+    bench("decode_timestamp epoch us", 
+          lambda: json_codec.decode_timestamp(1380000000000000), count)
+
+
+if __name__ == "__main__":
+    count = 10000
+
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    run(count)
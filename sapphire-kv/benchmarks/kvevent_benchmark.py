@@ -0,0 +1,144 @@
+#
+# <license>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+# 
+# 
+# Copyright 2013 Sapphire Open Systems
+#  
+# </license>
+#
+
+# Compares allocation size and construct/serialize throughput of
+# KVEvent against the previous dict and RLock based event class.
+#
+# usage: python kvevent_benchmark.py [count]
+
+import sys
+import time
+import threading
+from datetime import datetime
+
+from sapphire.core import KVEvent
+
+
+class LegacyKVEvent(object):
+    def __init__(self, 
+                 key=None, 
+                 value=None, 
+                 timestamp=None, 
+                 object_id=None, 
+                 origin_id=None):
+
+        self.__dict__["_lock"] = threading.RLock()
+
+        self.__dict__["key"] = key
+        self.__dict__["value"] = value
+        self.__dict__["timestamp"] = timestamp
+        self.__dict__["object_id"] = object_id
+        self.__dict__["origin_id"] = origin_id
+        self.__dict__["kvobject"] = None
+
+    def __getattr__(self, key):
+        if key == "_lock":
+            return self.__dict__[key]
+
+        else:
+            with self.__dict__["_lock"]: 
+                if key == self.__dict__["key"]:
+                    return self.__dict__["value"]
+
+                else:
+                    return self.__dict__[key]
+
+    def __setattr__(self, key, value):
+        with self._lock:
+            if key == self.key:
+                self.value = value
+
+            else:
+                self.__dict__[key] = value
+
+    def to_dict(self):
+        with self._lock:
+            d = {"object_id": self.object_id,
+                 "origin_id": self.origin_id,
+                 "key": self.key,
+                 "value": self.value,
+                 "timestamp": self.timestamp.isoformat()}
+
+        return d
+
+    def from_dict(self, d):
+        with self._lock:
+            self.object_id = d["object_id"]
+            self.origin_id = d["origin_id"]
+            self.key = d["key"]
+            self.value = d["value"]
+
+            try:
+                self.timestamp = datetime.strptime(d["timestamp"], "%Y-%m-%dT%H:%M:%S.%f")
+
+            except ValueError:
+                self.timestamp = datetime.strptime(d["timestamp"], "%Y-%m-%dT%H:%M:%S")                
+
+        return self
+
+
+def allocation_size(event):
+    size = sys.getsizeof(event)
+
+    if hasattr(event, "__dict__"):
+        size += sys.getsizeof(event.__dict__)
+
+    try:
+        size += sys.getsizeof(event._lock)
+
+    except (AttributeError, KeyError):
+        pass
+
+    return size
+
+
+def bench(name, fn, count):
+    start = time.time()
+
+    for i in xrange(count):
+        fn()
+
+    elapsed = time.time() - start
+
+    print "%-40s %10.0f ops/s" % (name, count / elapsed)
+
+
+def run(count):
+    now = datetime.utcnow()
+
+    for name, cls in [("legacy", LegacyKVEvent), ("slotted", KVEvent)]:
+        def construct():
+            return cls(key="temperature", 
+                       value=21.5, 
+                       timestamp=now, 
+                       object_id="sensor_0", 
+                       origin_id="origin")
+
+        event = construct()
+        d = event.to_dict()
+
+        print "%s: %d bytes per event" % (name, allocation_size(event))
+
+        bench("%s construct" % (name), construct, count)
+        bench("%s read attributes" % (name), 
+              lambda: (event.key, event.value, event.object_id, event.temperature), count)
+        bench("%s to_dict" % (name), event.to_dict, count)
+        bench("%s from_dict" % (name), lambda: cls().from_dict(d), count)
+
+
+if __name__ == "__main__":
+    count = 100000
+
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    run(count)
@@ -0,0 +1,93 @@
+#
+# <license>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+# 
+# 
+# Copyright 2013 Sapphire Open Systems
+#  
+# </license>
+#
+
+# Measures KVObject attribute read and update throughput with N
+# reader threads and M writer threads on the same object.
+#
+# usage: python kvobject_contention_benchmark.py [readers] [writers] [seconds]
+
+import sys
+import time
+import threading
+
+from sapphire.core import KVObject
+
+
+class Worker(threading.Thread):
+    def __init__(self, obj, fn, stop_event):
+        super(Worker, self).__init__()
+
+        self.obj = obj
+        self.fn = fn
+        self.stop_event = stop_event
+        self.count = 0
+
+        self.daemon = True
+
+    def run(self):
+        obj = self.obj
+        fn = self.fn
+
+        while not self.stop_event.is_set():
+            for i in xrange(100):
+                fn(obj, i)
+
+            self.count += 100
+
+
+def read(obj, i):
+    return obj.value
+
+def write(obj, i):
+    obj.update("value", i)
+
+
+def run(readers, writers, seconds):
+    obj = KVObject(collection="benchmark", value=0, other=1, name="benchmark")
+
+    stop_event = threading.Event()
+
+    reader_threads = [Worker(obj, read, stop_event) for i in xrange(readers)]
+    writer_threads = [Worker(obj, write, stop_event) for i in xrange(writers)]
+
+    for t in reader_threads + writer_threads:
+        t.start()
+
+    time.sleep(seconds)
+    stop_event.set()
+
+    for t in reader_threads + writer_threads:
+        t.join()
+
+    reads = sum([t.count for t in reader_threads])
+    writes = sum([t.count for t in writer_threads])
+
+    print "readers: %d writers: %d" % (readers, writers)
+    print "reads:  %10.0f /s" % (reads / seconds)
+    print "writes: %10.0f /s" % (writes / seconds)
+
+
+if __name__ == "__main__":
+    readers = 4
+    writers = 1
+    seconds = 5.0
+
+    if len(sys.argv) > 1:
+        readers = int(sys.argv[1])
+
+    if len(sys.argv) > 2:
+        writers = int(sys.argv[2])
+
+    if len(sys.argv) > 3:
+        seconds = float(sys.argv[3])
+
+    run(readers, writers, seconds)
@@ -0,0 +1,138 @@
+#
+# <license>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#
+# Copyright 2013 Sapphire Open Systems
+#
+# </license>
+#
+
+# Measures memory and thread count per macro and per KVProcess, the
+# latency from KVProcess.start() to setup() and from an event to a
+# macro action, on the shared runtime.
+#
+# usage: python runtime_benchmark.py [macros] [processes]
+
+import sys
+import time
+import threading
+
+from sapphire.core import KVObject, KVObjectsManager, KVEvent, KVProcess
+from sapphire.automaton import Macro, Trigger, Action, Query
+
+
+def rss_kb():
+    # linux only
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+
+    return 0
+
+
+class AnyTrigger(Trigger):
+    def condition(self, event):
+        return True
+
+
+class TimedAction(Action):
+    def __init__(self):
+        super(TimedAction, self).__init__()
+
+        self.done = threading.Event()
+
+    def action(self, event):
+        self.done.set()
+
+
+class TimedProcess(KVProcess):
+    blocking_loop = False
+
+    def __init__(self, **kwargs):
+        self._started = threading.Event()
+
+        super(TimedProcess, self).__init__(**kwargs)
+
+    def setup(self):
+        self._started.set()
+
+    def loop(self):
+        # run again in a second without holding a worker
+        return 1.0
+
+
+def measure_macros(count):
+    obj = KVObject(collection="benchmark", value=0)
+    KVObjectsManager._add_object(obj)
+
+    rss = rss_kb()
+    threads = threading.active_count()
+
+    actions = list()
+
+    for i in xrange(count):
+        action = TimedAction()
+        actions.append(action)
+
+        Macro(triggers=[AnyTrigger(source=Query(object_id=obj.object_id), keys="value")],
+              actions=[action])
+
+    print "macros: %d" % (count)
+    print "  memory:  %8.1f KB/macro" % (float(rss_kb() - rss) / count)
+    print "  threads: %8d" % (threading.active_count() - threads)
+
+    for m in Macro._macros:
+        m._setup()
+
+    start = time.time()
+    KVEvent(key="value", value=1, object_id=obj.object_id).receive()
+
+    for action in actions:
+        action.done.wait(10.0)
+
+    print "  event to last action: %8.3f ms" % ((time.time() - start) * 1000.0)
+    print "  threads: %8d" % (threading.active_count() - threads)
+
+
+def measure_processes(count):
+    rss = rss_kb()
+    threads = threading.active_count()
+
+    processes = [TimedProcess() for i in xrange(count)]
+
+    print "processes: %d" % (count)
+    print "  memory:  %8.1f KB/process" % (float(rss_kb() - rss) / count)
+    print "  threads: %8d" % (threading.active_count() - threads)
+
+    latencies = list()
+
+    for p in processes:
+        start = time.time()
+        p.start()
+        p._started.wait(10.0)
+        latencies.append(time.time() - start)
+
+    print "  start latency: avg %8.3f ms max %8.3f ms" % \
+            ((sum(latencies) / len(latencies)) * 1000.0, max(latencies) * 1000.0)
+    print "  threads: %8d" % (threading.active_count() - threads)
+
+    for p in processes:
+        p.kill()
+
+
+if __name__ == "__main__":
+    macros = 500
+    processes = 500
+
+    if len(sys.argv) > 1:
+        macros = int(sys.argv[1])
+
+    if len(sys.argv) > 2:
+        processes = int(sys.argv[2])
+
+    measure_macros(macros)
+    measure_processes(processes)
@@ -0,0 +1,161 @@
+#
+# <license>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+# 
+# 
+# Copyright 2013 Sapphire Open Systems
+#  
+# </license>
+#
+
+# Compares Store write throughput against the previous engine: a table
+# without a key, a SELECT then INSERT or UPDATE per write, and a commit
+# (with fsync) per write. The previous engine scans the table for every
+# write, so it runs on fewer keys by default. Also compares repeated
+# reads and writes of a few keys with and without the cache.
+#
+# usage: python store_benchmark.py [keys] [previous engine keys]
+
+import sys
+import os
+import time
+import json
+import shutil
+import sqlite3
+import tempfile
+
+from sapphire.core.store import Store
+
+
+def value(i):
+    return {"name": "key_%d" % (i), "count": i, "enabled": True}
+
+
+def report(name, count, elapsed):
+    print "%-45s %8d keys %10.0f writes/sec" % (name, count, count / elapsed)
+
+
+def bench_previous(path, count):
+    conn = sqlite3.connect(os.path.join(path, "previous.db"))
+    c = conn.cursor()
+
+    c.execute('''CREATE TABLE IF NOT EXISTS kv_data (key, value)''')
+    conn.commit()
+
+    start = time.time()
+
+    for i in xrange(count):
+        key = "key_%d" % (i)
+
+        c.execute('''SELECT value FROM kv_data WHERE key=?''', (key,))
+
+        if not c.fetchone():
+            c.execute('''INSERT INTO kv_data VALUES (?,?)''', (key, json.dumps(value(i)),))
+
+        else:
+            c.execute('''UPDATE kv_data SET value=? WHERE key=?''', (json.dumps(value(i)), key,))
+
+        conn.commit()
+
+    report("previous, commit per write", count, time.time() - start)
+
+    conn.close()
+
+
+def bench_store(path, count):
+    store = Store(db_path=path, db_name="setitem.db")
+
+    start = time.time()
+
+    for i in xrange(count):
+        store["key_%d" % (i)] = value(i)
+
+    report("Store[key] = value", count, time.time() - start)
+
+    store.close()
+
+    store = Store(db_path=path, db_name="transaction.db")
+
+    start = time.time()
+
+    with store.transaction():
+        for i in xrange(count):
+            store["key_%d" % (i)] = value(i)
+
+    report("Store[key] = value in transaction()", count, time.time() - start)
+
+    store.close()
+
+    store = Store(db_path=path, db_name="update_many.db")
+
+    start = time.time()
+
+    store.update_many(("key_%d" % (i), value(i)) for i in xrange(count))
+
+    report("Store.update_many()", count, time.time() - start)
+
+    keys = ["key_%d" % (i) for i in xrange(count)]
+
+    start = time.time()
+
+    store.get_many(keys)
+
+    elapsed = time.time() - start
+
+    print "%-45s %8d keys %10.0f reads/sec" % ("Store.get_many()", count, count / elapsed)
+
+    store.close()
+
+
+def bench_cache(path, count):
+    # the same 100 keys read and written over and over
+    for name, options in [("uncached", {}), 
+                          ("cached", {"cache_size": 100, "write_buffer_size": 1000})]:
+        store = Store(db_path=path, db_name="%s.db" % (name), **options)
+
+        store.update_many(("key_%d" % (i), value(i)) for i in xrange(100))
+
+        start = time.time()
+
+        for i in xrange(count):
+            store["key_%d" % (i % 100)]
+
+        elapsed = time.time() - start
+
+        print "%-45s %8d keys %10.0f reads/sec" % ("Store[key] %s, 100 hot keys" % (name), count, count / elapsed)
+
+        start = time.time()
+
+        for i in xrange(count):
+            store["key_%d" % (i % 100)] = value(i)
+
+        store.flush()
+
+        report("Store[key] = value %s, 100 hot keys" % (name), count, time.time() - start)
+
+        print "  %s" % (store.stats())
+
+        store.close()
+
+
+if __name__ == "__main__":
+    count = 100000
+    previous_count = 10000
+
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    if len(sys.argv) > 2:
+        previous_count = int(sys.argv[2])
+
+    path = tempfile.mkdtemp()
+
+    try:
+        bench_previous(path, previous_count)
+        bench_store(path, count)
+        bench_cache(path, count)
+
+    finally:
+        shutil.rmtree(path)
@@ -0,0 +1,146 @@
+#
+# <license>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+# 
+# 
+# Copyright 2013 Sapphire Open Systems
+#  
+# </license>
+#
+
+# Measures Store read and write throughput with N reader threads and
+# M writer threads, against a single connection shared under a lock.
+#
+# usage: python store_concurrency_benchmark.py [readers] [writers] [seconds] [keys]
+
+import sys
+import os
+import time
+import json
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+
+from sapphire.core.store import Store
+
+
+class LockedStore(object):
+    # one connection for all threads, serialized by a lock
+    def __init__(self, path):
+        super(LockedStore, self).__init__()
+
+        self.conn = sqlite3.connect(os.path.join(path, "locked.db"),
+                                    isolation_level=None,
+                                    check_same_thread=False)
+        self.lock = threading.Lock()
+
+        self.conn.execute('''PRAGMA journal_mode=WAL''')
+        self.conn.execute('''PRAGMA synchronous=NORMAL''')
+        self.conn.execute('''CREATE TABLE kv_data (key PRIMARY KEY, value)''')
+
+    def __getitem__(self, key):
+        with self.lock:
+            row = self.conn.execute('''SELECT value FROM kv_data WHERE key=?''', (key,)).fetchone()
+
+        return json.loads(row[0])
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.conn.execute('''INSERT OR REPLACE INTO kv_data VALUES (?,?)''',
+                              (key, json.dumps(value)))
+
+
+class Worker(threading.Thread):
+    def __init__(self, store, fn, keys, stop_event):
+        super(Worker, self).__init__()
+
+        self.store = store
+        self.fn = fn
+        self.keys = keys
+        self.stop_event = stop_event
+        self.count = 0
+
+        self.daemon = True
+
+    def run(self):
+        store = self.store
+        fn = self.fn
+        keys = self.keys
+
+        while not self.stop_event.is_set():
+            for i in xrange(100):
+                fn(store, "key_%d" % (random.randrange(keys)), i)
+
+            self.count += 100
+
+
+def read(store, key, i):
+    return store[key]
+
+def write(store, key, i):
+    store[key] = {"name": key, "count": i, "enabled": True}
+
+
+def run(name, store, readers, writers, seconds, keys):
+    for i in xrange(keys):
+        write(store, "key_%d" % (i), 0)
+
+    stop_event = threading.Event()
+
+    reader_threads = [Worker(store, read, keys, stop_event) for i in xrange(readers)]
+    writer_threads = [Worker(store, write, keys, stop_event) for i in xrange(writers)]
+
+    for t in reader_threads + writer_threads:
+        t.start()
+
+    time.sleep(seconds)
+    stop_event.set()
+
+    for t in reader_threads + writer_threads:
+        t.join()
+
+    reads = sum([t.count for t in reader_threads])
+    writes = sum([t.count for t in writer_threads])
+
+    print "%s, readers: %d writers: %d" % (name, readers, writers)
+    print "  reads:  %10.0f /s" % (reads / seconds)
+    print "  writes: %10.0f /s" % (writes / seconds)
+
+
+if __name__ == "__main__":
+    readers = 4
+    writers = 1
+    seconds = 5.0
+    keys = 10000
+
+    if len(sys.argv) > 1:
+        readers = int(sys.argv[1])
+
+    if len(sys.argv) > 2:
+        writers = int(sys.argv[2])
+
+    if len(sys.argv) > 3:
+        seconds = float(sys.argv[3])
+
+    if len(sys.argv) > 4:
+        keys = int(sys.argv[4])
+
+    path = tempfile.mkdtemp()
+
+    try:
+        run("single locked connection", LockedStore(path), readers, writers, seconds, keys)
+
+        store = Store(db_path=path, db_name="store.db")
+        run("Store", store, readers, writers, seconds, keys)
+        store.close()
+
+        store = Store(db_path=path, db_name="cached.db", cache_size=keys)
+        run("Store, cache_size=%d" % (keys), store, readers, writers, seconds, keys)
+        store.close()
+
+    finally:
+        shutil.rmtree(path)
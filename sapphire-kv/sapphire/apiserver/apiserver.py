@@ -10,8 +10,11 @@
 # </license>
 #
 
-from events import EventQueue
+from events import EventSubscription, EventFilter, _event_log
 from sapphire.core import KVObjectsManager, KVObject, KVEvent, settings
+from sapphire.core import SIGNAL_EXPIRED_KVOBJECT
+from sapphire.core import origin
+from sapphire.core.runtime import get_runtime
 
 import os
 import json
@@ -19,12 +22,25 @@ import logging
 import datetime
 import time
 import threading
+import collections
+import heapq
+import itertools
+import zlib
 
 import bottle
 from beaker.middleware import SessionMiddleware
+from pydispatch import dispatcher
 
 API_SERVER_PORT = 8000
 API_SERVER_STATIC_ROOT = os.getcwd()
+API_OBJECT_CACHE_SIZE = 4096
+API_EVENT_STREAM_KEEPALIVE = 15.0
+API_GZIP_MIN_SIZE = 1024
+API_GZIP_CACHE_SIZE = 64
+
+# bottle server adapter, "gevent" serves streaming clients without
+# holding a thread each
+API_SERVER_BACKEND = "paste"
 
 try:
     API_SERVER_PORT = settings.API_SERVER_PORT
@@ -33,6 +49,25 @@ try:
 except:
     pass
 
+try:
+    API_SERVER_BACKEND = settings.API_SERVER_BACKEND
+
+except:
+    pass
+
+try:
+    API_OBJECT_CACHE_SIZE = settings.API_OBJECT_CACHE_SIZE
+
+except:
+    pass
+
+try:
+    API_GZIP_MIN_SIZE = settings.API_GZIP_MIN_SIZE
+    API_GZIP_CACHE_SIZE = settings.API_GZIP_CACHE_SIZE
+
+except:
+    pass
+
 INTERFACE = ('0.0.0.0', API_SERVER_PORT)
 VERSION = "1.0"
 
@@ -58,6 +93,327 @@ class ApiServerJsonEncoder(json.JSONEncoder):
         else:
             return super(ApiServerJsonEncoder, self).default(obj)
 
+
+class EncodedObjectCache(object):
+    # LRU cache of encoded JSON per object, keyed by (object_id, updated_at)
+    def __init__(self, size=API_OBJECT_CACHE_SIZE):
+        super(EncodedObjectCache, self).__init__()
+
+        self.size = size
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def encode(self, obj):
+        # snapshot the timestamp and data together
+        with obj._lock:
+            updated_at = obj.updated_at
+
+            with self._lock:
+                entry = self._entries.pop(obj.object_id, None)
+
+                if entry is not None and entry[0] == updated_at:
+                    self._entries[obj.object_id] = entry
+
+                    return entry[1]
+
+            data = obj.to_dict()
+
+        encoded = ApiServerJsonEncoder().encode(data)
+
+        with self._lock:
+            self._entries[obj.object_id] = (updated_at, encoded)
+
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+        return encoded
+
+    def discard(self, object_id):
+        with self._lock:
+            self._entries.pop(object_id, None)
+
+_object_cache = EncodedObjectCache()
+
+
+class GzipCache(object):
+    # LRU cache of gzip compressed response bodies, keyed by path and
+    # ETag
+    def __init__(self, size=API_GZIP_CACHE_SIZE):
+        super(GzipCache, self).__init__()
+
+        self.size = size
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.pop(key, None)
+
+            if body is not None:
+                self._entries[key] = body
+
+            return body
+
+    def put(self, key, body):
+        with self._lock:
+            self._entries[key] = body
+
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+_gzip_cache = GzipCache()
+
+
+def _object_expired(kvobject):
+    _object_cache.discard(kvobject.object_id)
+
+dispatcher.connect(_object_expired, signal=SIGNAL_EXPIRED_KVOBJECT)
+
+def _etag(version):
+    # weak, since the same version may be sent gzip encoded or not.
+    # objects, collections and the registry share one version counter,
+    # so the path and query string select the representation. versions
+    # start over in every process, the origin id tells them apart
+    # across restarts and servers.
+    resource = bottle.request.path + "?" + bottle.request.query_string
+
+    return 'W/"%s-%d-%08x"' % (origin.id, version, zlib.crc32(resource) & 0xffffffff)
+
+def _gzip_key(etag):
+    if etag is None:
+        return None
+
+    return (bottle.request.path, etag)
+
+def _etag_matches(header, etag):
+    if header.strip() == "*":
+        return True
+
+    etag = etag[2:]
+
+    for tag in header.split(","):
+        tag = tag.strip()
+
+        if tag.startswith("W/"):
+            tag = tag[2:]
+
+        if tag == etag:
+            return True
+
+    return False
+
+def _check_version(version):
+    # sets the ETag and Last-Modified validators for a (version,
+    # modified) pair, and answers with 304 Not Modified if the client
+    # already has this version. returns the ETag.
+    if version is None:
+        return None
+
+    headers = {"ETag": _etag(version[0]),
+               "Last-Modified": bottle.http_date(version[1])}
+
+    if_none_match = bottle.request.get_header('If-None-Match')
+    if_modified_since = bottle.request.get_header('If-Modified-Since')
+
+    if if_none_match:
+        not_modified = _etag_matches(if_none_match, headers["ETag"])
+
+    elif if_modified_since:
+        # dates have a resolution of one second, a change in the same
+        # second as the client's copy may be newer than it
+        since = bottle.parse_date(if_modified_since.split(";")[0].strip())
+        not_modified = since is not None and int(version[1]) < since
+
+    else:
+        not_modified = False
+
+    if not_modified:
+        raise bottle.HTTPResponse(status=304, headers=headers)
+
+    for k, v in headers.iteritems():
+        bottle.response.set_header(k, v)
+
+    return headers["ETag"]
+
+def _accepts_gzip():
+    return "gzip" in bottle.request.get_header('Accept-Encoding', '')
+
+def _gzip_body(body, etag):
+    # compresses a complete body, if it is worth it
+    bottle.response.set_header('Vary', 'Accept-Encoding')
+
+    if not _accepts_gzip() or len(body) < API_GZIP_MIN_SIZE:
+        return body
+
+    key = _gzip_key(etag)
+    compressed = None
+
+    if key:
+        compressed = _gzip_cache.get(key)
+
+    if compressed is None:
+        z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compressed = z.compress(body) + z.flush()
+
+        if key:
+            _gzip_cache.put(key, compressed)
+
+    bottle.response.set_header('Content-Encoding', 'gzip')
+
+    return compressed
+
+def _gzip_stream(chunks, key):
+    # compresses a streamed body as it is sent, and caches the result
+    # once complete. small single chunk bodies are sent as is.
+    chunks = iter(chunks)
+
+    first = next(chunks, "")
+    second = next(chunks, None)
+
+    if second is None and len(first) < API_GZIP_MIN_SIZE:
+        yield first
+        return
+
+    # bottle applies headers set before the first chunk
+    bottle.response.set_header('Content-Encoding', 'gzip')
+
+    z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    out = list()
+
+    if second is not None:
+        chunks = itertools.chain([first, second], chunks)
+
+    else:
+        chunks = [first]
+
+    for chunk in chunks:
+        data = z.compress(chunk)
+
+        if data:
+            out.append(data)
+            yield data
+
+    data = z.flush()
+    out.append(data)
+
+    if key:
+        _gzip_cache.put(key, "".join(out))
+
+    yield data
+
+def _respond(chunks, etag):
+    bottle.response.set_header('Vary', 'Accept-Encoding')
+
+    if not _accepts_gzip():
+        return chunks
+
+    key = _gzip_key(etag)
+
+    if key:
+        compressed = _gzip_cache.get(key)
+
+        if compressed is not None:
+            bottle.response.set_header('Content-Encoding', 'gzip')
+
+            return compressed
+
+    return _gzip_stream(chunks, key)
+
+# query parameters that control the response instead of the query
+_PAGE_PARAMS = ["limit", "cursor", "fields"]
+
+# flush the response every this many bytes
+_STREAM_CHUNK_SIZE = 65536
+
+def _query_criteria(params):
+    return dict((k, params.get(k)) for k in params if k not in _PAGE_PARAMS)
+
+def _page(items, params):
+    # pages are ordered by object id, and the cursor is the last
+    # object id of the previous page. returns (items, next cursor).
+    object_id = lambda o: o.object_id
+
+    cursor = params.get("cursor")
+
+    if cursor:
+        items = [o for o in items if o.object_id > cursor]
+
+    limit = params.get("limit")
+
+    if limit is None:
+        return sorted(items, key=object_id), None
+
+    try:
+        limit = int(limit)
+
+    except ValueError:
+        bottle.abort(400, "Invalid limit")
+
+    if limit <= 0:
+        bottle.abort(400, "Invalid limit")
+
+    # only the page needs sorting
+    items = heapq.nsmallest(limit + 1, items, key=object_id)
+
+    if len(items) > limit:
+        return items[:limit], items[limit - 1].object_id
+
+    return items, None
+
+def _project(obj, fields):
+    d = obj.to_dict()
+
+    projected = dict((f, d[f]) for f in fields if f in d)
+    projected["object_id"] = obj.object_id
+
+    return projected
+
+def _stream_objects(items, fields):
+    # encodes one object at a time, so the response starts right
+    # away and the whole list is never encoded at once
+    encoder = ApiServerJsonEncoder()
+
+    buf = ["["]
+    size = 1
+
+    for i in xrange(len(items)):
+        if fields:
+            data = encoder.encode(_project(items[i], fields))
+
+        else:
+            data = _object_cache.encode(items[i])
+
+        if i > 0:
+            buf.append(", ")
+
+        buf.append(data)
+        size += len(data) + 2
+
+        if size >= _STREAM_CHUNK_SIZE:
+            yield "".join(buf)
+
+            buf = list()
+            size = 0
+
+    buf.append("]")
+
+    yield "".join(buf)
+
+def _encode_page(items, params):
+    items, next_cursor = _page(items, params)
+
+    if next_cursor is not None:
+        bottle.response.set_header('X-Next-Cursor', next_cursor)
+
+    fields = params.get("fields")
+
+    if fields:
+        fields = [f.strip() for f in fields.split(",") if f.strip()]
+
+    return _stream_objects(items, fields)
+
 ################
 # Static Files
 ################
@@ -80,26 +436,33 @@ def get_root_collection():
 
 @bottle.get(API_PATH + '/objects')
 def get_objects():
-    if len(bottle.request.params) == 0:
+    # any change to the registry changes this list
+    etag = _check_version(KVObjectsManager.version())
+
+    criteria = _query_criteria(bottle.request.params)
+
+    if len(criteria) == 0:
         items = KVObjectsManager.query(all=True)
 
     else:
-        items = KVObjectsManager.query(**bottle.request.params)
+        items = KVObjectsManager.query(**criteria)
 
     bottle.response.set_header('Content-Type', 'application/json')
 
-    return ApiServerJsonEncoder().encode(items)
+    return _respond(_encode_page(items, bottle.request.params), etag)
 
 @bottle.get(API_PATH + '/objects/<key>')
 def get_object_data(key=None):
-    items = KVObjectsManager.query(object_id=key)
+    etag = _check_version(KVObjectsManager.object_version(key))
 
-    if len(items) == 0:
+    obj = KVObjectsManager.lookup(key)
+
+    if obj is None:
         bottle.abort(404, "Object not found")
 
     bottle.response.set_header('Content-Type', 'application/json')
 
-    return ApiServerJsonEncoder().encode(items[0])
+    return _gzip_body(_object_cache.encode(obj), etag)
 
 @bottle.get(API_PATH + '/collections')
 def get_collection_list():
@@ -111,30 +474,30 @@ def get_collection_list():
 
 @bottle.get(API_PATH + '/collections/<collection>')
 def get_object_collection(collection=None):
-    if len(bottle.request.params) == 0:
-        items = KVObjectsManager.query(collection=collection)
+    etag = _check_version(KVObjectsManager.collection_version(collection))
 
-    else:
-        items = KVObjectsManager.query(collection=collection, **bottle.request.params)
+    items = KVObjectsManager.query(collection=collection, **_query_criteria(bottle.request.params))
 
     if len(items) == 0:
         bottle.abort(404, "Collection not found")
 
     bottle.response.set_header('Content-Type', 'application/json')
 
-    return ApiServerJsonEncoder().encode(items)
+    return _respond(_encode_page(items, bottle.request.params), etag)
 
 
 @bottle.get(API_PATH + '/collections/<collection>/<key>')
 def get_collection_object_data(collection=None, key=None):
-    items = KVObjectsManager.query(collection=collection, object_id=key)
+    etag = _check_version(KVObjectsManager.object_version(key))
 
-    if len(items) == 0:
+    obj = KVObjectsManager.lookup(key, collection=collection)
+
+    if obj is None:
         bottle.abort(404, "Object not found")
 
     bottle.response.set_header('Content-Type', 'application/json')
 
-    return ApiServerJsonEncoder().encode(items[0])
+    return _gzip_body(_object_cache.encode(obj), etag)
 
 ########
 # POST
@@ -145,7 +508,7 @@ def post_object():
     obj = KVObject(object_id=None, origin_id=None, **bottle.request.json)
 
     # publish to exchange
-    obj.publish()
+    obj.notify()
 
     return ApiServerJsonEncoder().encode(obj)
 
@@ -164,18 +527,19 @@ def put_object_data(key=None):
     else:
         bottle.abort(422, "Object ID required")
 
-    # query for existing object
-    items = KVObjectsManager.query(object_id=object_id)
+    # look up existing object
+    existing = KVObjectsManager.lookup(object_id)
 
-    if len(items) > 0:
+    if existing is not None:
         # delete existing object
-        items[0].delete()
+        existing.delete()
+        _object_cache.discard(object_id)
 
     # create new object with key and parameters
     obj = KVObject(object_id=object_id, **bottle.request.json)
 
     # publish to exchange
-    obj.publish()
+    obj.notify()
 
     return ApiServerJsonEncoder().encode(obj)
 
@@ -185,81 +549,203 @@ def put_object_data(key=None):
 @bottle.route(API_PATH + '/objects/<key>', method='patch')
 # NOTE: bottle does not have a shortcut path method, so route is used
 def patch_object_data(key=None):
-    items = KVObjectsManager.query(object_id=key)
+    obj = KVObjectsManager.lookup(key)
 
     try:
         # if new object
-        if len(items) == 0:
+        if obj is None:
             bottle.abort(404, "Object not found")
 
         else:
-            obj = items[0]
 
             # update attributes
             obj.batch_set(bottle.request.json)
             
         # publish to exchange
-        obj.publish()
+        obj.notify()
 
     except KeyError:
         bottle.abort(422, "Cannot modify given parameters")
 
     return ApiServerJsonEncoder().encode(obj)
 
+#########
+# Batch
+#########
+def _batch_items():
+    items = bottle.request.json
+
+    if not isinstance(items, list):
+        bottle.abort(400, "Expected a list of objects")
+
+    return items
+
+def _batch_response(results):
+    bottle.response.set_header('Content-Type', 'application/json')
+
+    return json.dumps(results)
+
+@bottle.post(API_PATH + '/objects\\:batch')
+def post_objects_batch():
+    # create many objects, published together
+    results = list()
+    objects = list()
+    object_ids = set()
+
+    for item in _batch_items():
+        if not isinstance(item, dict):
+            results.append({"status": 400, "error": "Expected an object"})
+            continue
+
+        object_id = item.get("object_id")
+
+        if object_id is not None and \
+           (object_id in object_ids or KVObjectsManager.lookup(object_id) is not None):
+            results.append({"status": 409, "object_id": object_id, "error": "Object exists"})
+            continue
+
+        attrs = dict([(k, v) for k, v in item.iteritems() 
+                      if k not in ["object_id", "origin_id"]])
+
+        try:
+            obj = KVObject(object_id=object_id, **attrs)
+
+        except (KeyError, TypeError, ValueError):
+            results.append({"status": 422, "object_id": object_id, "error": "Invalid parameters"})
+            continue
+
+        objects.append(obj)
+        object_ids.add(obj.object_id)
+
+        results.append({"status": 201, "object_id": obj.object_id})
+
+    KVObjectsManager.put_objects(objects)
+
+    return _batch_response(results)
+
+@bottle.route(API_PATH + '/objects\\:batch', method='patch')
+def patch_objects_batch():
+    # update many objects, events are published together
+    results = list()
+    objects = dict()
+
+    for item in _batch_items():
+        if not isinstance(item, dict) or "object_id" not in item:
+            results.append({"status": 400, "error": "Object ID required"})
+            continue
+
+        object_id = item["object_id"]
+
+        obj = KVObjectsManager.lookup(object_id)
+
+        if obj is None:
+            results.append({"status": 404, "object_id": object_id, "error": "Object not found"})
+            continue
+
+        updates = dict([(k, v) for k, v in item.iteritems() if k != "object_id"])
+
+        # keys set before an invalid one stay set, so publish them too
+        objects[object_id] = obj
+
+        try:
+            obj.batch_set(updates)
+
+        except KeyError:
+            results.append({"status": 422, "object_id": object_id, "error": "Cannot modify given parameters"})
+            continue
+
+        results.append({"status": 200, "object_id": object_id})
+
+    KVObjectsManager.notify_objects(objects.values())
+
+    return _batch_response(results)
+
 ##########
 # DELETE
 ##########
 @bottle.delete(API_PATH + '/objects/<key>')
 def delete_object(key=None):
-    items = KVObjectsManager.query(object_id=key)
+    obj = KVObjectsManager.lookup(key)
 
     # check if object exists
-    if len(items) == 0:
+    if obj is None:
         bottle.abort(404, "Object not found")
 
-    obj = items[0]
-
     obj.delete()
 
+    _object_cache.discard(key)
+
 
 #################
 # Event Channel
 #################
-class SessionReaper(threading.Thread):
+class SessionReaper(object):
+    # checks the session on a runtime timer instead of a thread
     def __init__(self, session):
         super(SessionReaper, self).__init__()
 
         self.session = session
 
-        self.start()
+        get_runtime().call_later(30.0, self._check)
     
-    def run(self):
-        while (time.time() - self.session['_accessed_time']) < 300:
-            time.sleep(30.0)
+    def _check(self):
+        if (time.time() - self.session['_accessed_time']) < 300:
+            get_runtime().call_later(30.0, self._check)
+            return
 
         logging.debug("Reaping session: %s" % self.session.id)
+
+        if "events" in self.session:
+            self.session["events"].close()
+
         self.session.delete()
 
 
+_FILTER_PARAMS = {"collection": "collections",
+                  "object_id": "object_ids",
+                  "key": "keys"}
+
+def _event_filter_spec(params):
+    # collection, object_id and key may be repeated. any other
+    # parameters are query criteria on the object, except private
+    # ones such as cache busters.
+    spec = {"criteria": dict()}
+
+    for param, name in _FILTER_PARAMS.iteritems():
+        spec[name] = params.getall(param)
+
+    for k in params:
+        if k not in _FILTER_PARAMS and not k.startswith('_'):
+            spec["criteria"][k] = params.get(k)
+
+    return spec
+
 @bottle.get(API_PATH + '/events')
 def events_collection():
     # get session, this will automatically create the session
     # if it did not exist
     session = bottle.request.environ.get('beaker.session')
 
-    # check if there is a query for this session
+    spec = _event_filter_spec(bottle.request.query)
+
+    # check if there is a subscription for this session
     if "events" not in session:
         # create reaper for session
         SessionReaper(session)
 
-        # create an event queue
-        session["events"] = EventQueue()
+        # subscribe to matching events
+        session["events"] = EventSubscription(**spec)
     
         logging.debug("Starting new events session: %s" % (session.id))
 
         # return immediately to send session cookie to client
         #return
 
+    elif session["events"].spec != spec:
+        # the filter changed
+        session["events"].close()
+        session["events"] = EventSubscription(**spec)
+
     # wait for stuff in queue
     events = [session["events"].get(block=True, timeout=60.0)]
 
@@ -274,6 +760,55 @@ def events_collection():
     return ApiServerJsonEncoder().encode(events)
 
 
+def _stream_events(cursor, event_filter):
+    encoder = ApiServerJsonEncoder()
+
+    # reconnect delay for the client, in milliseconds
+    yield "retry: 2000\n\n"
+
+    while True:
+        entries = _event_log.read(cursor, timeout=API_EVENT_STREAM_KEEPALIVE)
+
+        if len(entries) == 0:
+            # keep alive comment
+            yield ":\n\n"
+            continue
+
+        chunks = list()
+
+        for seq, event, collection in entries:
+            cursor = seq
+
+            if event_filter.matches(event, collection):
+                chunks.append("id: %d\ndata: %s\n\n" % (seq, encoder.encode(event)))
+
+        if len(chunks) > 0:
+            yield "".join(chunks)
+
+@bottle.get(API_PATH + '/events/stream')
+def events_stream():
+    # server-sent events from the shared event log, filtered by the
+    # collection, object_id and key query parameters
+    event_filter = EventFilter(collections=bottle.request.query.getall("collection"),
+                               object_ids=bottle.request.query.getall("object_id"),
+                               keys=bottle.request.query.getall("key"))
+
+    # resume after the last event the client has seen
+    last_event_id = bottle.request.get_header("Last-Event-ID") or \
+                    bottle.request.query.get("last_event_id")
+
+    try:
+        cursor = int(last_event_id)
+
+    except (TypeError, ValueError):
+        cursor = _event_log.last_seq()
+
+    bottle.response.set_header('Content-Type', 'text/event-stream')
+    bottle.response.set_header('Cache-Control', 'no-cache')
+
+    return _stream_events(cursor, event_filter)
+
+
 # these options control the Beaker sessions
 session_opts = {
     'session.type': 'memory',
@@ -282,8 +817,10 @@ session_opts = {
 }
 
 class APIServer(object):
-    def __init__(self):
+    def __init__(self, backend=API_SERVER_BACKEND):
         super(APIServer, self).__init__()
+
+        self.backend = backend
     
     def run(self):
         logging.info("APIServer serving on interface: %s port: %d" % (INTERFACE[0], INTERFACE[1]))
@@ -292,8 +829,12 @@ class APIServer(object):
         server_app = SessionMiddleware(bottle.app(), session_opts)
         #bottle.run(app=server_app, host=INTERFACE[0], port=INTERFACE[1], server='paste', quiet=settings.API_SERVER_QUIET)
 
-        # NOTE: if daemon_threads is False, the server will tend to not terminate when requested
-        bottle.run(app=server_app, host=INTERFACE[0], port=INTERFACE[1], server='paste', daemon_threads=True)
+        if self.backend == "paste":
+            # NOTE: if daemon_threads is False, the server will tend to not terminate when requested
+            bottle.run(app=server_app, host=INTERFACE[0], port=INTERFACE[1], server='paste', daemon_threads=True)
+
+        else:
+            bottle.run(app=server_app, host=INTERFACE[0], port=INTERFACE[1], server=self.backend)
         
     
 
@@ -10,24 +10,211 @@
 # </license>
 #
 
-from Queue import Queue
-import weakref
+from Queue import Queue, Empty, Full
+import threading
 
+from sapphire.core import KVObjectsManager, settings
 from sapphire.core import SIGNAL_RECEIVED_KVEVENT, SIGNAL_SENT_KVEVENT
+from sapphire.core.index import index_key
 
 from pydispatch import dispatcher
 
 MAX_QUEUED_EVENTS = 512
+API_EVENT_BUFFER_SIZE = 4096
 
-class EventQueue(Queue):
+try:
+    API_EVENT_BUFFER_SIZE = settings.API_EVENT_BUFFER_SIZE
 
-    _event_q_list = weakref.WeakSet()
+except:
+    pass
 
-    def __init__(self, **kwargs):
-        # Queue is an old-style class
-        Queue.__init__(self, **kwargs)
 
-        EventQueue._event_q_list.add(self)
+class EventSubscription(object):
+    # events for one long-polling session. filters on collections or
+    # criteria are registered with the object manager's subscription
+    # index, keyed on object_id and key, so only matching events are
+    # routed here and stored. filters on object ids and keys alone are
+    # matched on the event itself, so they also get events for objects
+    # that are not in the registry.
+    def __init__(self, collections=None, object_ids=None, keys=None, criteria=None):
+        super(EventSubscription, self).__init__()
+
+        self.spec = {"collections": collections or [],
+                     "object_ids": object_ids or [],
+                     "keys": keys or [],
+                     "criteria": criteria or {}}
+
+        self._q = Queue(maxsize=MAX_QUEUED_EVENTS)
+        self._subscriptions = list()
+        self._direct_routes = list()
+
+        if keys:
+            keys = list(keys)
+
+        else:
+            keys = None
+
+        if not collections and not criteria:
+            for object_id in object_ids or [None]:
+                for key in keys or [None]:
+                    self._direct_routes.append((object_id, key))
+
+            with _routes_lock:
+                for route in self._direct_routes:
+                    if route not in _direct_routes:
+                        _direct_routes[route] = set()
+
+                    _direct_routes[route].add(self)
+
+            return
+
+        # one subscription per collection and object id, so they never
+        # overlap and an event is stored once
+        for collection in collections or [None]:
+            for object_id in object_ids or [None]:
+                c = dict(criteria or {})
+
+                if collection is not None:
+                    c["collection"] = collection
+
+                if object_id is not None:
+                    c["object_id"] = object_id
+
+                if len(c) == 0:
+                    c["all"] = True
+
+                sub = KVObjectsManager.add_subscription(c, keys, None)
+                self._subscriptions.append(sub)
+
+                with _routes_lock:
+                    _routes[sub] = self
+
+    def put(self, event):
+        # never blocks the event threads, drops the oldest event
+        while True:
+            try:
+                self._q.put_nowait(event)
+                return
+
+            except Full:
+                try:
+                    self._q.get_nowait()
+
+                except Empty:
+                    pass
+
+    def get(self, block=True, timeout=None):
+        return self._q.get(block, timeout)
+
+    def empty(self):
+        return self._q.empty()
+
+    def close(self):
+        for sub in self._subscriptions:
+            with _routes_lock:
+                _routes.pop(sub, None)
+
+            KVObjectsManager.remove_subscription(sub)
+
+        self._subscriptions = list()
+
+        with _routes_lock:
+            for route in self._direct_routes:
+                sessions = _direct_routes.get(route)
+
+                if sessions is None:
+                    continue
+
+                sessions.discard(self)
+
+                if len(sessions) == 0:
+                    del _direct_routes[route]
+
+        self._direct_routes = list()
+
+
+# subscription -> EventSubscription
+_routes = dict()
+
+# (object_id, key) -> EventSubscriptions, None matches any
+_direct_routes = dict()
+
+_routes_lock = threading.Lock()
+
+
+class EventLog(object):
+    # ring buffer of recent events shared by all streaming clients.
+    # every event gets a sequence number, and each client only keeps
+    # a cursor: the last sequence number it has seen.
+    def __init__(self, size=API_EVENT_BUFFER_SIZE):
+        super(EventLog, self).__init__()
+
+        self.size = size
+
+        self._cond = threading.Condition()
+        self._entries = [None] * size
+        self._seq = 0
+
+    def last_seq(self):
+        return self._seq
+
+    def append(self, event):
+        # the collection is recorded now, the object may be gone by
+        # the time a client reads the event
+        obj = event.kvobject or KVObjectsManager.lookup(event.object_id)
+
+        if obj is not None:
+            collection = obj._attrs.get("collection")
+
+        else:
+            collection = None
+
+        with self._cond:
+            self._seq += 1
+            self._entries[self._seq % self.size] = (self._seq, event, collection)
+
+            self._cond.notify_all()
+
+    def read(self, cursor, timeout=None):
+        # returns (seq, event, collection) entries after cursor, waiting
+        # up to timeout for new ones. a cursor older than the buffer
+        # resumes from the oldest entry, one from the future (such as
+        # from before a server restart) resumes from now.
+        with self._cond:
+            if cursor > self._seq:
+                cursor = self._seq
+
+            if cursor == self._seq:
+                self._cond.wait(timeout)
+
+            first = max(cursor + 1, self._seq - self.size + 1)
+
+            return [self._entries[seq % self.size] for seq in xrange(first, self._seq + 1)]
+
+
+class EventFilter(object):
+    # server side event filter, empty lists match everything
+    def __init__(self, collections=None, object_ids=None, keys=None):
+        super(EventFilter, self).__init__()
+
+        self.collections = set([index_key(c) for c in collections or []])
+        self.object_ids = set(object_ids or [])
+        self.keys = set(keys or [])
+
+    def matches(self, event, collection):
+        if self.object_ids and event.object_id not in self.object_ids:
+            return False
+
+        if self.keys and event.key not in self.keys:
+            return False
+
+        if self.collections and index_key(collection) not in self.collections:
+            return False
+
+        return True
+
+
+_event_log = EventLog()
 
 
 def process_event(event):
@@ -35,12 +222,29 @@ def process_event(event):
     if event.private():
         return
 
-    for q in EventQueue._event_q_list:
-        q.put(event)
+    _event_log.append(event)
 
-        # limit size of queue
-        if q.qsize() > MAX_QUEUED_EVENTS:
-            q.get()
+    sessions = set()
+
+    if len(_direct_routes) > 0:
+        routes = [(None, event.key), (None, None)]
+
+        if event.object_id is not None:
+            routes += [(event.object_id, event.key), (event.object_id, None)]
+
+        with _routes_lock:
+            for route in routes:
+                sessions.update(_direct_routes.get(route, []))
+
+    if len(_routes) > 0:
+        for sub in KVObjectsManager.match_subscriptions(event):
+            q = _routes.get(sub)
+
+            if q is not None:
+                sessions.add(q)
+
+    for q in sessions:
+        q.put(event)
 
 
 dispatcher.connect(process_event, signal=SIGNAL_RECEIVED_KVEVENT)
@@ -10,13 +10,46 @@
 # </license>
 #
 
+import os
+import json
+import appdirs
+
+
+def _configured_backend():
+    # reads API_SERVER_BACKEND from the config file the same way
+    # settings.load_config() finds it, without importing sapphire
+    paths = ["sapphire.conf",
+             os.path.join(appdirs.user_data_dir("sapphire", "SapphireOpenSystems"), "sapphire.conf")]
+
+    for path in paths:
+        try:
+            f = open(path, 'r')
+
+        except IOError:
+            continue
+
+        try:
+            return json.loads(f.read()).get("API_SERVER_BACKEND")
+
+        finally:
+            f.close()
+
+    return None
+
+# gevent has to patch the standard library before anything else
+# imports it, so streaming clients and the object manager run as
+# greenlets
+if _configured_backend() == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
+
+
 import apiserver
 
 from sapphire.core.version import VERSION
 from sapphire.core import settings
 from sapphire.core import KVObjectsManager
 
-import os
 import sys
 import logging
 import argparse
@@ -30,9 +63,11 @@ def main():
     logging.info("Process ID: %d" % (os.getpid()))
         
 
+    backend = getattr(settings, "API_SERVER_BACKEND", apiserver.API_SERVER_BACKEND)
+
     KVObjectsManager.start()
 
-    api_server = apiserver.APIServer()
+    api_server = apiserver.APIServer(backend=backend)
     api_server.run()
 
     KVObjectsManager.stop()
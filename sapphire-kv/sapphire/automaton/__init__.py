@@ -15,6 +15,7 @@ from app import run
 from action import *
 from sapphire.core import KVEvent
 from sapphire.core import KVObject
+from sapphire.core import SIGNAL_EXPIRED_KVOBJECT
 from macro import *
 from query import Query
 from trigger import *
@@ -49,8 +49,8 @@ class TargetAction(Action):
         super(TargetAction, self).__init__(**kwargs)
 
     def run(self, event):
-        # run target query
-        targets = self.targets()
+        # read targets from the live view of the target query
+        targets = self.targets.view().objects()
 
         # if query came up empty, log and return
         if len(targets) == 0:
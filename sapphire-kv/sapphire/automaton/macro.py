@@ -16,24 +16,98 @@ import logging
 from datetime import datetime
 from apscheduler.scheduler import Scheduler
 
-from sapphire.core import SIGNAL_RECEIVED_KVEVENT
+from sapphire.core import SIGNAL_RECEIVED_KVEVENT, KVObjectsManager
+from sapphire.core.runtime import Mailbox
+import trigger
 
 from pydispatch import dispatcher
 
-from Queue import Queue, Empty
 import threading
-import time
 
 _sched = None
 
 
-class Macro(threading.Thread):
+def _overrides(obj, cls, name):
+    return getattr(type(obj), name).__func__ is not getattr(cls, name).__func__
+
+
+class _MacroRouter(object):
+    # works out which macros can possibly fire on an event, from the
+    # interest of their triggers
+    def __init__(self):
+        super(_MacroRouter, self).__init__()
+
+        self._lock = threading.Lock()
+
+        # id(interval trigger) -> macros
+        self._intervals = dict()
+
+        # key -> macros, for triggers with keys but no source
+        self._keys = dict()
+
+        # macros with triggers whose interest can't be worked out
+        self._fallback = set()
+
+        # subscription -> macro, for triggers with a source query.
+        # the object manager maintains which objects match.
+        self._subscriptions = dict()
+
+    def add(self, macro, trig):
+        with self._lock:
+            if _overrides(trig, trigger.Trigger, "_eval"):
+                # a custom _eval can fire on anything
+                self._fallback.add(macro)
+
+            elif isinstance(trig, trigger.IntervalTrigger) and \
+               not _overrides(trig, trigger.IntervalTrigger, "condition"):
+                self._intervals.setdefault(id(trig), set()).add(macro)
+
+            elif not _overrides(trig, trigger.Trigger, "condition"):
+                # the default condition never fires
+                pass
+
+            elif trig.source_query:
+                sub = KVObjectsManager.add_subscription(trig.source_query.criteria, trig.keys, None)
+                self._subscriptions[sub] = macro
+
+            elif trig.keys is not None:
+                for key in trig.keys:
+                    self._keys.setdefault(key, set()).add(macro)
+
+            else:
+                self._fallback.add(macro)
+
+    def route(self, event):
+        with self._lock:
+            macros = set(self._fallback)
+
+            macros.update(self._keys.get(event.key, []))
+
+            if event.key == "__interval_trigger":
+                macros.update(self._intervals.get(event.value, []))
+
+            if len(self._subscriptions) > 0:
+                for sub in KVObjectsManager.match_subscriptions(event):
+                    if sub in self._subscriptions:
+                        macros.add(self._subscriptions[sub])
+
+        return macros
+
+
+class Macro(object):
     _macros = list()
+    _router = _MacroRouter()
 
     @staticmethod
     def receive_event(event):
-        for m in Macro._macros:
-            m.event_q.put(event)
+        # a macro sees an event at most once, however many of its
+        # triggers are interested in it
+        for m in Macro._router.route(event):
+            if not m.running:
+                continue
+
+            m.delivered += 1
+            m.event_q.post(event)
 
     def __init__(self, triggers=list(), actions=list()):
         super(Macro, self).__init__()
@@ -50,68 +124,75 @@ class Macro(threading.Thread):
         self.last_run = None
         self.running = True
         self.paused = True
-        self.daemon = True
+
+        # events delivered vs. events that fired the actions
+        self.delivered = 0
+        self.fired = 0
 
         self._macros.append(self)
 
-        self.event_q = Queue()
+        # events are evaluated one at a time on the shared runtime.
+        # events arriving while paused are held until resumed.
+        self.event_q = Mailbox(self._process_event)
+        self.event_q.pause()
 
-        self.start()
+        for t in self.triggers:
+            self._router.add(self, t)
 
     def _setup(self):
         for action in self.actions:
             action.init()
 
+        self.paused = False
+        self.event_q.resume()
+
         # init triggers last so that interval triggers with
         # run_now set will be able to trigger actions
         for trigger in self.triggers:
             trigger.init()
 
-        self.paused = False       
-
     def _pause(self):
         self.paused = True
+        self.event_q.pause()
 
     def _shutdown(self):
         self.paused = True
         self.running = False
 
-    def run(self):
-        while self.running:
+        self.event_q.pause()
+        self.event_q.clear()
 
-            while self.paused:
-                time.sleep(1.0)
+    def _process_event(self, event):
+        self.last_run = datetime.utcnow()
 
+        for trigger in self.triggers:
             try:
-                event = self.event_q.get(True, 1.0)
+                if not trigger._eval(event):
+                    continue
                 
-                self.last_run = datetime.utcnow()
+                logging.debug("Macro: %s triggered by: %s" % (self, trigger))
 
-                for trigger in self.triggers:
+                self.fired += 1
+
+                for action in self.actions:
+                    
                     try:
-                        if not trigger._eval(event):
-                            continue
+                        logging.debug("Running action: %s" % (action))
                         
-                        logging.debug("Macro: %s triggered by: %s" % (self, trigger))
-
-                        for action in self.actions:
-                            
-                            try:
-                                logging.debug("Running action: %s" % (action))
-                                
-                                action.run(event)    
-                                
-                            except Exception as e:
-                                logging.error("Action: %s raised exception: %s" % (str(action), str(e)))
+                        action.run(event)    
+                        
+                    except Exception as e:
+                        logging.error("Action: %s raised exception: %s" % (str(action), str(e)))
 
-                        # we match only one of the triggers
-                        break
+                # we match only one of the triggers
+                break
 
-                    except Exception as e:
-                        logging.error("Trigger: %s raised exception: %s" % (str(trigger), str(e)))
+            except Exception as e:
+                logging.error("Trigger: %s raised exception: %s" % (str(trigger), str(e)))
 
-            except Empty:
-                pass
+    def stats(self):
+        return {"delivered": self.delivered,
+                "fired": self.fired}
         
 
 dispatcher.connect(Macro.receive_event, signal=SIGNAL_RECEIVED_KVEVENT)
@@ -10,17 +10,5 @@
 # </license>
 #
 
-from sapphire.core import KVObjectsManager
-
-class Query(object):
-    def __init__(self, **kwargs):
-        super(Query, self).__init__()
-
-        self.criteria = kwargs
-
-    def __str__(self):
-        s = "Query: %s" % (self.criteria)
-        return s
-
-    def __call__(self):
-        return KVObjectsManager.query(**self.criteria)
+# automaton queries are core queries, so they share live views
+from sapphire.core.query import Query
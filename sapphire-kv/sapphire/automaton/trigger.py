@@ -17,17 +17,29 @@ import macro
 
 
 class Trigger(object):
-    def __init__(self, source=None):
+    def __init__(self, source=None, keys=None):
         super(Trigger, self).__init__()
 
         self.source_query = source
 
+        # keys the condition is interested in, None for any key
+        if isinstance(keys, basestring):
+            keys = [keys]
+
+        if keys is not None:
+            keys = list(keys)
+
+        self.keys = keys
+
     def init(self):
         pass
 
     def _eval(self, event):
+        if self.keys is not None and event.key not in self.keys:
+            return False
+
         if self.source_query:
-            if event.object_id not in [o.object_id for o in self.source_query()]:
+            if event.object_id not in self.source_query.view():
                 return False
         
         return self.condition(event)
@@ -11,7 +11,7 @@
 #
 
 from kvevent import KVEvent, SIGNAL_RECEIVED_KVEVENT, SIGNAL_SENT_KVEVENT
-from kvobject import KVObject, KVObjectsManager
+from kvobject import KVObject, KVObjectsManager, SIGNAL_EXPIRED_KVOBJECT
 from query import Query
 from kvprocess import KVProcess
 
@@ -0,0 +1,62 @@
+#
+# <license>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+# 
+# 
+# Copyright 2013 Sapphire Open Systems
+#  
+# </license>
+#
+
+import hashlib
+
+from index import index_key
+
+
+def collection_key(collection):
+    if collection is None:
+        return ""
+
+    return index_key(collection)
+
+
+def _object_hash(object_id, updated_at):
+    s = u"%s|%s" % (object_id, updated_at.isoformat())
+
+    return int(hashlib.md5(s.encode("utf-8")).hexdigest(), 16)
+
+
+def compute(objects):
+    # builds a digest of {collection: [hash, count]} over the
+    # (object_id, updated_at) pairs of the given objects.
+    # object hashes are combined with xor, so the digest does not
+    # depend on iteration order and needs no sorting.
+    digests = dict()
+
+    for obj in objects:
+        # writers replace the attributes before the timestamp, read
+        # them together
+        with obj._lock:
+            collection = obj._attrs.get("collection")
+            updated_at = obj.updated_at
+
+        key = collection_key(collection)
+
+        if key not in digests:
+            digests[key] = [0, 0]
+
+        digests[key][0] ^= _object_hash(obj.object_id, updated_at)
+        digests[key][1] += 1
+
+    return dict((k, ["%032x" % (v[0]), v[1]]) for k, v in digests.iteritems())
+
+
+def diff(local, remote):
+    # returns (collections that differ or are missing locally,
+    #          collections that only exist locally)
+    changed = [k for k, v in remote.iteritems() if local.get(k) != v]
+    removed = [k for k in local if k not in remote]
+
+    return changed, removed
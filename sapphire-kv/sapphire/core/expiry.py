@@ -0,0 +1,96 @@
+#
+# <license>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+# 
+# 
+# Copyright 2013 Sapphire Open Systems
+#  
+# </license>
+#
+
+import math
+import time
+
+
+class TimerWheel(object):
+    # hashed timing wheel. arm and cancel are O(1), expiring visits
+    # only the slots for the ticks that have passed.
+    # not thread safe, callers provide locking.
+    def __init__(self, resolution=1.0, slots=128, now=None):
+        super(TimerWheel, self).__init__()
+
+        if now is None:
+            now = time.time()
+
+        self.resolution = resolution
+
+        self._slots = [set() for i in xrange(slots)]
+
+        # key -> deadline tick
+        self._deadlines = dict()
+
+        # the last tick expired
+        self._last_tick = int(math.floor(now / resolution))
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def _tick(self, t):
+        return int(math.ceil(t / self.resolution))
+
+    def arm(self, key, deadline):
+        # returns the time the key will expire at, deadlines that
+        # have passed expire on the next tick
+        self.cancel(key)
+
+        tick = max(self._tick(deadline), self._last_tick + 1)
+
+        self._deadlines[key] = tick
+        self._slots[tick % len(self._slots)].add(key)
+
+        return tick * self.resolution
+
+    def cancel(self, key):
+        tick = self._deadlines.pop(key, None)
+
+        if tick is not None:
+            self._slots[tick % len(self._slots)].discard(key)
+
+    def next_deadline(self):
+        # returns the time of the first tick with keys in its slot,
+        # or None if the wheel is empty. keys further than one
+        # revolution out may share that slot, so this is a lower bound.
+        if len(self._deadlines) == 0:
+            return None
+
+        start = self._last_tick
+
+        for tick in xrange(start + 1, start + 1 + len(self._slots)):
+            if len(self._slots[tick % len(self._slots)]) > 0:
+                return tick * self.resolution
+
+        return (start + 1) * self.resolution
+
+    def expire(self, now):
+        # removes and returns all keys whose deadline has passed
+        now_tick = int(math.floor(now / self.resolution))
+
+        # visit each slot at most once
+        first_tick = max(self._last_tick + 1, now_tick - len(self._slots) + 1)
+
+        expired = list()
+
+        for tick in xrange(first_tick, now_tick + 1):
+            slot = self._slots[tick % len(self._slots)]
+
+            for key in [k for k in slot if self._deadlines[k] <= now_tick]:
+                slot.discard(key)
+                del self._deadlines[key]
+
+                expired.append(key)
+
+        self._last_tick = now_tick
+
+        return expired
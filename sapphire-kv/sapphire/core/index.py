@@ -0,0 +1,219 @@
+#
+# <license>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+# 
+# 
+# Copyright 2013 Sapphire Open Systems
+#  
+# </license>
+#
+
+import threading
+
+
+# attributes that are always indexed.
+# object_id is served directly from the object registry.
+DEFAULT_INDEXES = ["collection", "origin_id"]
+
+# query keywords that are not attribute comparisons
+_QUERY_KEYWORDS = ["all", "expr", "contains"]
+
+# object_id is the registry key, and updated_at changes on every
+# write without going through the index
+_UNINDEXABLE = ["object_id", "updated_at"]
+
+
+def index_key(value):
+    # queryable.query_dict compares values by their string
+    # representation, so the index has to use the same key
+    try:
+        return str(value)
+
+    except UnicodeEncodeError:
+        return value
+
+
+class Index(object):
+    def __init__(self, attr):
+        super(Index, self).__init__()
+
+        self.attr = attr
+
+        # value key -> set of object ids
+        self._entries = dict()
+
+        # object id -> value key
+        self._values = dict()
+
+    def __len__(self):
+        return len(self._values)
+
+    def set(self, object_id, value):
+        key = index_key(value)
+
+        if object_id in self._values:
+            if self._values[object_id] == key:
+                return
+
+            self.discard(object_id)
+
+        self._values[object_id] = key
+
+        if key not in self._entries:
+            self._entries[key] = set()
+
+        self._entries[key].add(object_id)
+
+    def discard(self, object_id):
+        if object_id not in self._values:
+            return
+
+        key = self._values.pop(object_id)
+
+        ids = self._entries[key]
+        ids.discard(object_id)
+
+        if len(ids) == 0:
+            del self._entries[key]
+
+    def lookup(self, value):
+        return self._entries.get(index_key(value), set())
+
+
+class ObjectIndex(object):
+    def __init__(self):
+        super(ObjectIndex, self).__init__()
+
+        # this lock is never held while acquiring any other lock
+        self._lock = threading.Lock()
+
+        self._indexes = dict()
+
+        # attribute name -> set of object ids that have the attribute
+        self._keys = dict()
+
+        for attr in DEFAULT_INDEXES:
+            self._indexes[attr] = Index(attr)
+
+    def _get_attrs(self, obj):
+        attrs = dict(obj._attrs)
+        attrs["object_id"] = obj.object_id
+        attrs["origin_id"] = obj.origin_id
+        attrs["updated_at"] = obj.updated_at
+
+        return attrs
+
+    def indexes(self):
+        with self._lock:
+            return self._indexes.keys()
+
+    def create_index(self, attr, objects):
+        if attr in _UNINDEXABLE:
+            raise ValueError("Cannot index attribute: %s" % (attr))
+
+        with self._lock:
+            if attr in self._indexes:
+                return
+
+            index = Index(attr)
+
+            for obj in objects:
+                attrs = self._get_attrs(obj)
+
+                if attr in attrs:
+                    index.set(obj.object_id, attrs[attr])
+
+            self._indexes[attr] = index
+
+    def drop_index(self, attr):
+        if attr in DEFAULT_INDEXES:
+            raise ValueError("Cannot drop default index: %s" % (attr))
+
+        with self._lock:
+            if attr in self._indexes:
+                del self._indexes[attr]
+
+    def add(self, obj):
+        attrs = self._get_attrs(obj)
+
+        with self._lock:
+            for k, v in attrs.iteritems():
+                if k in self._indexes:
+                    self._indexes[k].set(obj.object_id, v)
+
+                if k not in self._keys:
+                    self._keys[k] = set()
+
+                self._keys[k].add(obj.object_id)
+
+    def remove(self, object_id):
+        with self._lock:
+            for index in self._indexes.itervalues():
+                index.discard(object_id)
+
+            for k in self._keys.keys():
+                ids = self._keys[k]
+                ids.discard(object_id)
+
+                if len(ids) == 0:
+                    del self._keys[k]
+
+    def update(self, object_id, key, value):
+        with self._lock:
+            if key in self._indexes:
+                self._indexes[key].set(object_id, value)
+
+            if key not in self._keys:
+                self._keys[key] = set()
+
+            self._keys[key].add(object_id)
+
+    def plan(self, criteria):
+        # returns a tuple of (candidate object ids, exact).
+        # candidates is None if no index applies and the caller has
+        # to scan. exact is True if every criterion was answered by
+        # an index and the candidates need no further filtering.
+        lookups = list()
+        exact = "expr" not in criteria
+
+        with self._lock:
+            for k, v in criteria.iteritems():
+                if k in _QUERY_KEYWORDS:
+                    continue
+
+                if k == "object_id":
+                    # the registry is keyed on object id
+                    lookups.append(set([index_key(v)]))
+
+                elif k in self._indexes:
+                    lookups.append(self._indexes[k].lookup(v))
+
+                else:
+                    exact = False
+
+            if "contains" in criteria:
+                attr_list = criteria["contains"]
+
+                if isinstance(attr_list, basestring):
+                    attr_list = [attr_list]
+
+                for attr in attr_list:
+                    lookups.append(self._keys.get(attr, set()))
+
+            if len(lookups) == 0:
+                return None, False
+
+            # start with the most selective index and narrow it down
+            lookups.sort(key=len)
+
+            candidates = set(lookups[0])
+
+            for ids in lookups[1:]:
+                if len(candidates) == 0:
+                    break
+
+                candidates &= ids
+
+        return candidates, exact
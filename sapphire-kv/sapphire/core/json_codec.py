@@ -11,10 +11,65 @@
 #
 
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import json
 
+try:
+    import msgpack
+
+except ImportError:
+    msgpack = None
+
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def encode_timestamp(dt):
+    return dt.isoformat()
+
+def encode_epoch_us(dt):
+    delta = dt - _EPOCH
+
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def decode_timestamp(value):
+    # binary codecs carry integer epoch microseconds
+    if isinstance(value, (int, long)):
+        return _EPOCH + timedelta(microseconds=value)
+
+    # parse the isoformat() layouts by hand, strptime is very slow
+    try:
+        if value[4] == '-' and value[7] == '-' and value[10] == 'T' and \
+           value[13] == ':' and value[16] == ':':
+
+            if len(value) == 19:
+                microsecond = 0
+
+            elif len(value) == 26 and value[19] == '.':
+                microsecond = int(value[20:26])
+
+            else:
+                raise ValueError
+
+            return datetime(int(value[0:4]),
+                            int(value[5:7]),
+                            int(value[8:10]),
+                            int(value[11:13]),
+                            int(value[14:16]),
+                            int(value[17:19]),
+                            microsecond)
+
+    except (ValueError, IndexError):
+        pass
+
+    try:
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f")
+
+    except ValueError:
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S")
+
+
 class Encoder(json.JSONEncoder):
     def default(self, obj):
         from kvobject import KVObject
@@ -33,3 +88,85 @@ class Decoder(json.JSONDecoder):
     def decode(self, obj):
         return super(Decoder, self).decode(obj)
 
+
+class JsonCodec(object):
+    name = "json"
+
+    def encode(self, msg):
+        return Encoder().encode(msg)
+
+    def decode(self, data):
+        return Decoder().decode(data)
+
+    def frame_batch(self, origin_id, msgs):
+        # messages are already encoded, so the batch is framed
+        # without decoding and re-encoding them
+        return '{"method": "batch", "origin_id": %s, "data": [%s]}' % \
+                (self.encode(origin_id), ", ".join(msgs))
+
+    def detect(self, data):
+        return data[:1] == '{'
+
+
+class MsgpackCodec(object):
+    name = "msgpack"
+
+    def _default(self, obj):
+        from kvobject import KVObject
+        from kvevent import KVEvent
+
+        if isinstance(obj, datetime):
+            return encode_epoch_us(obj)
+        elif isinstance(obj, KVObject):
+            return obj.to_dict(encode_timestamp=encode_epoch_us)
+        elif isinstance(obj, KVEvent):
+            return obj.to_dict(encode_timestamp=encode_epoch_us)
+        else:
+            raise TypeError("Cannot encode: %s" % (repr(obj)))
+
+    def encode(self, msg):
+        return msgpack.packb(msg, default=self._default, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+    def frame_batch(self, origin_id, msgs):
+        packer = msgpack.Packer(use_bin_type=True)
+
+        header = packer.pack_map_header(3) + \
+                 packer.pack("method") + \
+                 packer.pack("batch") + \
+                 packer.pack("origin_id") + \
+                 packer.pack(origin_id) + \
+                 packer.pack("data") + \
+                 packer.pack_array_header(len(msgs))
+
+        return header + "".join(msgs)
+
+    def detect(self, data):
+        # messages are always maps: fixmap, map16 or map32
+        c = ord(data[:1] or '\x00')
+
+        return (0x80 <= c <= 0x8f) or c == 0xde or c == 0xdf
+
+
+_codecs = {"json": JsonCodec()}
+
+if msgpack:
+    _codecs["msgpack"] = MsgpackCodec()
+
+
+def available_codecs():
+    return _codecs.keys()
+
+def get_codec(name):
+    return _codecs[name]
+
+def decode(data):
+    # receivers accept every codec they have, so mixed nodes can
+    # coexist while binary codecs are rolled out
+    for codec in _codecs.itervalues():
+        if codec.detect(data):
+            return codec.decode(data)
+
+    raise ValueError("Unknown message encoding")
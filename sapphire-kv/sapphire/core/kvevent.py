@@ -19,65 +19,84 @@ import json_codec
 import queryable
 
 from pydispatch import dispatcher
-import threading
 
 SIGNAL_RECEIVED_KVEVENT = "signal_received_kvevent"
 SIGNAL_SENT_KVEVENT = "signal_sent_kvevent"
 
 
 class KVEvent(object):
+    # events are immutable once built and are created in very large
+    # numbers, so they use slots and no lock
+    __slots__ = ["key", "value", "timestamp", "object_id", "origin_id", "kvobject"]
+
     def __init__(self, 
                  key=None, 
                  value=None, 
                  timestamp=None, 
                  object_id=None, 
-                 origin_id=origin.id):
+                 origin_id=origin.id,
+                 kvobject=None):
 
-        self.__dict__["_lock"] = threading.RLock()
+        _set = object.__setattr__
 
-        self.__dict__["key"] = key
-        self.__dict__["value"] = value
-        self.__dict__["timestamp"] = timestamp
-        self.__dict__["object_id"] = object_id
-        self.__dict__["origin_id"] = origin_id
-        self.__dict__["kvobject"] = None
+        _set(self, "key", key)
+        _set(self, "value", value)
+        _set(self, "timestamp", timestamp)
+        _set(self, "object_id", object_id)
+        _set(self, "origin_id", origin_id)
+        _set(self, "kvobject", kvobject)
 
     def __getattr__(self, key):
-        if key == "_lock":
-            return self.__dict__[key]
+        # called for names that are not slots, and for slots that are
+        # not set yet, such as while copying or unpickling.
+        # the event's key can be read as an attribute.
+        if key.startswith("__"):
+            raise AttributeError(key)
 
-        else:
-            with self.__dict__["_lock"]: 
-                if key == self.__dict__["key"]:
-                    return self.__dict__["value"]
+        try:
+            event_key = object.__getattribute__(self, "key")
+
+        except AttributeError:
+            raise AttributeError(key)
+
+        if key == event_key:
+            return object.__getattribute__(self, "value")
 
-                else:
-                    return self.__dict__[key]
+        raise AttributeError(key)
+
+    def __reduce__(self):
+        # copy and pickle rebuild the event through __init__, as
+        # __setattr__ refuses to set the slots
+        return (self.__class__, (self.key, 
+                          self.value, 
+                          self.timestamp, 
+                          self.object_id, 
+                          self.origin_id, 
+                          self.kvobject))
 
     def __setattr__(self, key, value):
-        with self._lock:
-            if key == self.key:
-                self.value = value
+        # the object an event applies to is bound after decoding
+        if key == "kvobject":
+            object.__setattr__(self, key, value)
 
-            else:
-                self.__dict__[key] = value
+        else:
+            raise AttributeError("KVEvent is immutable")
 
     def __str__(self):
-        with self._lock:
-            o_id = self.object_id
+        o_id = self.object_id
 
-            if self.kvobject:
-                try:
-                    o_id = self.kvobject.name
+        if self.kvobject:
+            try:
+                o_id = self.kvobject.name
 
-                except:
-                    pass
+            except:
+                pass
 
-            s = "Obj:%20s Key:%24s Val:%16s Time:%16s" % \
-                (o_id,
-                 self.key,
-                 self.value,
-                 self.timestamp)
+        s = "Obj:%20s Key:%24s Val:%16s Time:%16s" % \
+            (o_id,
+             self.key,
+             self.value,
+             self.timestamp)
 
         return s
 
@@ -89,52 +108,39 @@ class KVEvent(object):
 
         return None
 
-    def to_dict(self):
-        with self._lock:
-            d = {"object_id": self.object_id,
-                 "origin_id": self.origin_id,
-                 "key": self.key,
-                 "value": self.value,
-                 "timestamp": self.timestamp.isoformat()}
-
-        return d
+    def to_dict(self, encode_timestamp=json_codec.encode_timestamp):
+        return {"object_id": self.object_id,
+                "origin_id": self.origin_id,
+                "key": self.key,
+                "value": self.value,
+                "timestamp": encode_timestamp(self.timestamp)}
 
     def to_json(self):
-        with self._lock:
-            return json_codec.Encoder().encode(self.to_dict())
-
-    def from_dict(self, d):
-        with self._lock:
-            self.object_id = d["object_id"]
-            self.origin_id = d["origin_id"]
-            self.key = d["key"]
-            self.value = d["value"]
-
-            try:
-                self.timestamp = datetime.strptime(d["timestamp"], "%Y-%m-%dT%H:%M:%S.%f")
-
-            except ValueError:
-                self.timestamp = datetime.strptime(d["timestamp"], "%Y-%m-%dT%H:%M:%S")                
-
-        return self
-
-    def from_json(self, j):
-        with self._lock:
-            return self.from_dict(json_codec.Decoder().decode(j))
+        return json_codec.Encoder().encode(self.to_dict())
+
+    # from_dict and from_json build a new event. they are class
+    # methods so KVEvent.from_dict(d) skips the throwaway instance,
+    # while KVEvent().from_dict(d) keeps working.
+    @classmethod
+    def from_dict(cls, d):
+        return cls(key=d["key"],
+                   value=d["value"],
+                   timestamp=json_codec.decode_timestamp(d["timestamp"]),
+                   object_id=d["object_id"],
+                   origin_id=d["origin_id"])
+
+    @classmethod
+    def from_json(cls, j):
+        return cls.from_dict(json_codec.Decoder().decode(j))
 
     def send(self):
-        with self._lock:
-            # send dispatcher signal
-            dispatcher.send(signal=SIGNAL_SENT_KVEVENT, event=self)
+        # send dispatcher signal
+        dispatcher.send(signal=SIGNAL_SENT_KVEVENT, event=self)
 
     def receive(self):
-        with self._lock:
-            # send dispatcher signal
-            dispatcher.send(signal=SIGNAL_RECEIVED_KVEVENT, event=self)
+        # send dispatcher signal
+        dispatcher.send(signal=SIGNAL_RECEIVED_KVEVENT, event=self)
 
     def private(self):
-        with self._lock:
-            return self.key.startswith('_')
-
-
+        return self.key.startswith('_')
 
@@ -19,7 +19,14 @@ import collections
 import origin
 from kvevent import KVEvent, SIGNAL_RECEIVED_KVEVENT, SIGNAL_SENT_KVEVENT
 import queryable
-from pubsub import Publisher, Subscriber, ObjectSender
+import digest
+from index import ObjectIndex, index_key
+from subscription import SubscriptionRegistry
+from versioning import VersionTable
+from expiry import TimerWheel
+from runtime import Runtime, Mailbox, get_runtime
+from snapshot import RegistrySnapshot
+from pubsub import Publisher, Subscriber, ObjectSender, object_channel, collection_channel
 import json_codec
 from pydispatch import dispatcher
 import threading
@@ -30,6 +37,12 @@ import settings
 
 
 
+SIGNAL_EXPIRED_KVOBJECT = "signal_expired_kvobject"
+
+# minimum time between answers to sync requests for the same collection
+_SYNC_HOLDOFF = 1.0
+
+
 class NotOriginatorException(Exception):
     pass
 
@@ -55,6 +68,17 @@ class KVObject(object):
         self.__dict__["_attrs"] = None
         self.__dict__["_ttl"] = settings.OBJECT_TIME_TO_LIVE
 
+        # when the object expires, and which arming of the TTL
+        # processor is current
+        self.__dict__["_ttl_deadline"] = None
+        self.__dict__["_ttl_generation"] = 0
+
+        # loaded from the snapshot and not yet confirmed by its origin
+        self.__dict__["_stale"] = False
+
+        # channel the object was last published on
+        self.__dict__["_channel"] = None
+
         if object_id:
             self.object_id = object_id
         else:
@@ -76,16 +100,17 @@ class KVObject(object):
 
         self.set("collection", collection)
 
-    def to_dict(self):
-        with self._lock:
-            d = {"object_id": self.object_id,
-                 "origin_id": self.origin_id,
-                 "updated_at": self.updated_at.isoformat()}
+    def to_dict(self, encode_timestamp=json_codec.encode_timestamp):
+        # the attribute map is never modified in place, so it is read
+        # without the lock. writers replace it before updated_at, so
+        # take the lock where the two must match.
+        d = dict(self._attrs)
 
-            for k, v in self._attrs.iteritems():
-                d[k] = v
+        d["object_id"] = self.object_id
+        d["origin_id"] = self.origin_id
+        d["updated_at"] = encode_timestamp(self.updated_at)
 
-            return d
+        return d
 
     def to_json(self):
         return json_codec.Encoder().encode(self.to_dict())
@@ -101,16 +126,16 @@ class KVObject(object):
                 del d["origin_id"]
 
             if "updated_at" in d:
-                try:
-                    self.updated_at = datetime.strptime(d["updated_at"], "%Y-%m-%dT%H:%M:%S.%f")
-
-                except ValueError:
-                    self.updated_at = datetime.strptime(d["updated_at"], "%Y-%m-%dT%H:%M:%S")  
+                self.updated_at = json_codec.decode_timestamp(d["updated_at"])
 
                 del d["updated_at"]
 
+            attrs = dict(self._attrs)
+
             for k, v in d.iteritems():
-                self._attrs[k] = v
+                attrs[k] = v
+
+            self._attrs = attrs
 
             return self
 
@@ -119,6 +144,9 @@ class KVObject(object):
 
     def _reset_ttl(self):
         self._ttl = settings.OBJECT_TIME_TO_LIVE
+        self._ttl_deadline = time.time() + self._ttl
+
+        KVObjectsManager._arm_ttl(self)
 
     def _post_event(self, event):
         self._event_q.put(event)
@@ -136,24 +164,36 @@ class KVObject(object):
                 events.append(ev)
                 updates[ev.key] = ev.value
 
-            # run batch update on object
-            self.batch_update(updates)
+            if len(events) > 0:
+                # take the timestamp of the events, so our copy
+                # tracks the updated_at of the originator
+                previous = self.updated_at
+                timestamp = max(ev.timestamp for ev in events)
+
+                # run batch update on object
+                self.batch_update(updates, timestamp=timestamp)
+
+                self.updated_at = max(previous, timestamp)
+
+                # the origin is still sending events
+                self._stale = False
             
         for ev in events:
             ev.receive()
 
     def __str__(self):
-        with self._lock:
-            if self.collection:
-                s = "KVObject:%s.%s" % \
-                    (self.collection,
-                     self.object_id)
-            
-            else:
-                s = "KVObject:%s" % \
-                    (self.object_id)    
+        collection = self._attrs.get("collection")
 
-            return s
+        if collection:
+            s = "KVObject:%s.%s" % \
+                (collection,
+                 self.object_id)
+        
+        else:
+            s = "KVObject:%s" % \
+                (self.object_id)    
+
+        return s
 
     def query(self, **kwargs):
         d = self.to_dict()
@@ -164,25 +204,23 @@ class KVObject(object):
         return None
 
     def __getattr__(self, key):
-        if key == "_lock":
-            return self.__dict__[key]
-
-        else:
-            with self.__dict__["_lock"]:
-                if key in self.__dict__:
-                    return self.__dict__[key]
-                
-                else:
-                    return self._attrs[key]
+        # only called for names that are not in __dict__.
+        # writers replace the attribute map instead of modifying it,
+        # so reads need no lock.
+        return self.__dict__["_attrs"][key]
 
     def __setattr__(self, key, value):
-        with self._lock:
-            if (key in self.__dict__) or \
-               (key.startswith('_')):
-                self.__dict__[key] = value
+        if (key in self.__dict__) or \
+           (key.startswith('_')):
+            self.__dict__[key] = value
 
-            else:
-                self.set(key, value)
+            # every change to the object ends with a new timestamp
+            if key == "updated_at":
+                KVObjectsManager._object_touched(self)
+
+        else:
+            # set() serializes writers
+            self.set(key, value)
 
     def get(self, key):
         return self._attrs[key]
@@ -197,8 +235,12 @@ class KVObject(object):
             if (key in self._attrs) or \
                (key not in self._attrs and self.is_originator()):
 
-                # update current value
-                self._attrs[key] = value
+                # update current value, copy on write
+                attrs = dict(self._attrs)
+                attrs[key] = value
+                self._attrs = attrs
+
+                KVObjectsManager._object_changed(self, key, value)
 
                 if timestamp == None:
                     self.updated_at = datetime.utcnow()
@@ -224,27 +266,42 @@ class KVObject(object):
             self.set(k, v, timestamp=timestamp)
 
     def update(self, key, value, timestamp=None):    
-        with self._lock:
-            # check if key is already in the object dict
-            if key in self.__dict__:
-                raise KeyError
-
-            # check if changing
-            if key not in self._attrs or self._attrs[key] != value:
-                
-                # set new value
-                self._attrs[key] = value
-
-                # set timestamp
-                if timestamp == None:
-                    self.updated_at = datetime.utcnow()
-                else:
-                    self.updated_at = timestamp
-
+        self.batch_update({key: value}, timestamp=timestamp)
 
     def batch_update(self, updates, timestamp=None):
-        for k, v in updates.iteritems():
-            self.update(k, v, timestamp=timestamp)
+        with self._lock:
+            attrs = self._attrs
+            changed = list()
+
+            try:
+                for key, value in updates.iteritems():
+                    # check if key is already in the object dict
+                    if key in self.__dict__:
+                        raise KeyError
+
+                    # check if changing
+                    if key not in attrs or attrs[key] != value:
+                        # copy on write, once per batch
+                        if len(changed) == 0:
+                            attrs = dict(attrs)
+
+                        # set new value
+                        attrs[key] = value
+                        changed.append(key)
+
+            finally:
+                # keep the updates applied before an invalid key
+                if len(changed) > 0:
+                    self._attrs = attrs
+
+                    for key in changed:
+                        KVObjectsManager._object_changed(self, key, attrs[key])
+
+                    # set timestamp
+                    if timestamp == None:
+                        self.updated_at = datetime.utcnow()
+                    else:
+                        self.updated_at = timestamp
 
     def put(self):
         with self._lock:
@@ -252,38 +309,78 @@ class KVObject(object):
                 #if self.object_id not in KVObjectsManager._objects:
                 logging.debug("Publishing object: %s" % (str(self)))
 
+                channel, previous = self._move_channel()
+
+                msgs = [("publish", self, channel)]
+
+                if previous is not None:
+                    msgs.insert(0, ("delete", self, previous))
+
                 # publish to exchange
                 try:
-                    KVObjectsManager._publisher.publish_method("publish", self)
+                    KVObjectsManager._publisher.publish_many(msgs)
 
                 except AttributeError:
                     # publisher not running
                     pass
 
                 # add to objects registry
-                KVObjectsManager._objects[self.object_id] = self
+                KVObjectsManager._add_object(self)
 
     def notify(self):
+        self.updated_at = datetime.utcnow()
+
         # check if new object, and publish if not
         if self.object_id not in KVObjectsManager._objects:
             self.put()
 
-        self.updated_at = datetime.utcnow()
+        events = self._take_events()
 
         # push events to exchange
         try:
             # check if there are events to publish
-            if len(self._pending_events) > 0:
+            if len(events) > 0:
                 logging.debug("Pushing events: %s" % (str(self)))
-                KVObjectsManager.send_events(self._pending_events.values())
+
+                KVObjectsManager.send_events(events)
 
         except AttributeError:
             # publisher not running
             pass
 
+    def _take_events(self):
+        # stamp events with our updated_at so receivers end up
+        # with the same (object_id, updated_at) digest as us
+        events = [KVEvent(key=ev.key,
+                          value=ev.value,
+                          timestamp=self.updated_at,
+                          object_id=self.object_id) 
+                  for ev in self._pending_events.values()]
+
         # clear events
         self._pending_events = dict()
 
+        return events
+
+    def _move_channel(self):
+        # returns (channel, previous channel or None). the previous
+        # channel is returned if the collection changed since the
+        # object was last published, so subscribers of the old
+        # collection can be told it left.
+        channel = object_channel(self)
+        previous = self._channel
+
+        self._channel = channel
+
+        if previous is None or previous == channel:
+            return channel, None
+
+        return channel, previous
+
+    def notify_async(self):
+        # runs notify() on the runtime, returns a Future
+        return get_runtime().defer(self.notify)
+
     def _unpublish(self):
         with self._lock:
             if self.is_originator():
@@ -294,28 +391,88 @@ class KVObject(object):
             if self.is_originator():
                 logging.debug("Unpublishing object: %s" % (str(self)))
 
+                channel, previous = self._move_channel()
+
+                msgs = [("delete", self, channel)]
+
+                if previous is not None:
+                    msgs.insert(0, ("delete", self, previous))
+
                 try:
-                    KVObjectsManager._publisher.publish_method("delete", self)
+                    KVObjectsManager._publisher.publish_many(msgs)
 
                 except AttributeError:
                     # publisher not running
                     pass
                     
-                del KVObjectsManager._objects[self.object_id]
+                KVObjectsManager._remove_object(self.object_id)
 
             else:
                 raise NotOriginatorException
 
     def is_originator(self):
-        with self._lock:
-            return self.origin_id == origin.id
+        return self.origin_id == origin.id
+
+    def is_stale(self):
+        return self._stale
+
+
+class _ShardApplier(object):
+    # applies events for one shard of the objects. every object maps
+    # to exactly one shard, so its events are applied in order
+    # and never on two threads at once.
+    def __init__(self):
+        super(_ShardApplier, self).__init__()
+
+        # ids of objects that are queued and not yet applied
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+
+        # counters
+        self.applied = 0
+        self.apply_time = 0.0
+        self.max_apply_time = 0.0
+
+    def post(self, obj):
+        with self._pending_lock:
+            # the object will drain all of its queued events when it
+            # is applied, so it only needs to be queued once
+            if obj.object_id in self._pending:
+                return
+
+            self._pending.add(obj.object_id)
+
+        self._queue(obj)
 
+    def _apply(self, obj):
+        # events posted from here on need another pass
+        with self._pending_lock:
+            self._pending.discard(obj.object_id)
 
-class ObjectUpdateProcessor(threading.Thread):
-    def __init__(self, object_q=None):
+        start = time.time()
+
+        try:
+            # run batch update on object
+            obj._apply_events()
+
+        except KeyError as e:
+            logging.warning("Unable to apply events to %s, invalid key: %s" % (str(obj), str(e)))
+
+        except Exception as e:
+            logging.exception("ObjectUpdateProcessor unexpected exception: %s", str(e))
+
+        elapsed = time.time() - start
+
+        self.applied += 1
+        self.apply_time += elapsed
+        self.max_apply_time = max(self.max_apply_time, elapsed)
+
+
+class ObjectUpdateProcessor(_ShardApplier, threading.Thread):
+    def __init__(self):
         super(ObjectUpdateProcessor, self).__init__()
 
-        self._object_q = object_q
+        self._object_q = Queue()
 
         self._stop_event = threading.Event()
 
@@ -323,45 +480,108 @@ class ObjectUpdateProcessor(threading.Thread):
 
         self.start()
 
+    def _queue(self, obj):
+        self._object_q.put(obj)
+
+    def queue_depth(self):
+        return self._object_q.qsize()
+
     def run(self):
         while not self._stop_event.is_set():  
-            try:
-                # get work from queue
-                obj = self._object_q.get()
+            # get work from queue
+            obj = self._object_q.get()
 
-                # run batch update on object
-                obj._apply_events()
+            if obj is None:
+                continue
 
-            except KeyError:
-                pass
+            self._apply(obj)
 
-            except TypeError:
-                pass
+    def stop(self):
+        self._stop_event.set()
+        self._object_q.put(None)
 
-            except:
-                pass
+class RuntimeUpdateProcessor(_ShardApplier):
+    # a shard applied through a mailbox on the manager runtime
+    def __init__(self, runtime):
+        super(RuntimeUpdateProcessor, self).__init__()
+
+        self._mailbox = Mailbox(self._apply, runtime)
+
+    def _queue(self, obj):
+        self._mailbox.post(obj)
+
+    def queue_depth(self):
+        return len(self._mailbox)
 
     def stop(self):
-        self._stop_event.set()
+        self._mailbox.pause()
+        self._mailbox.clear()
 
 class EventProcessor(threading.Thread):
-    def __init__(self):
+    def __init__(self, workers=None, runtime=None):
         super(EventProcessor, self).__init__()
 
+        if workers is None:
+            workers = settings.EVENT_WORKERS
+
         self._event_q = Queue()
-        self._object_q = Queue()
+        self._runtime = runtime
 
         self._update_processors = []
 
-        for i in xrange(10):
-            self._update_processors.append(ObjectUpdateProcessor(self._object_q))
+        for i in xrange(workers):
+            if runtime:
+                self._update_processors.append(RuntimeUpdateProcessor(runtime))
+
+            else:
+                self._update_processors.append(ObjectUpdateProcessor())
 
         self._stop_event = threading.Event()
 
-        self.start()
+        # on the shared runtime, events are routed to their shards by
+        # the caller and this thread is never started
+        if not runtime:
+            self.start()
 
     def post_events(self, events):
-        self._event_q.put(events)
+        if self._runtime:
+            self._route(events)
+
+        else:
+            self._event_q.put(events)
+
+    def _processor_for(self, object_id):
+        return self._update_processors[hash(object_id) % len(self._update_processors)]
+
+    def stats(self):
+        applied = sum([p.applied for p in self._update_processors])
+        apply_time = sum([p.apply_time for p in self._update_processors])
+
+        if applied > 0:
+            avg_apply_time = apply_time / applied
+
+        else:
+            avg_apply_time = 0.0
+
+        return {"workers": len(self._update_processors),
+                "event_queue_depth": self._event_q.qsize(),
+                "object_queue_depth": [p.queue_depth() for p in self._update_processors],
+                "applied": applied,
+                "avg_apply_time": avg_apply_time,
+                "max_apply_time": max([p.max_apply_time for p in self._update_processors])}
+
+    def _route(self, events):
+        updates = dict()
+
+        # process events
+        for ev in events:
+            ev.kvobject._post_event(ev)
+
+            updates[ev.kvobject.object_id] = ev.kvobject
+
+        # route each object to its shard
+        for k, v in updates.iteritems():
+            self._processor_for(k).post(v)
 
     def run(self):
         while not self._stop_event.is_set():    
@@ -369,16 +589,7 @@ class EventProcessor(threading.Thread):
                 # get events from the queue
                 events = self._event_q.get()
 
-                updates = dict()
-
-                # process events
-                for ev in events:
-                    ev.kvobject._post_event(ev)
-
-                    updates[ev.kvobject.object_id] = ev.kvobject
-
-                for k, v in updates.iteritems():
-                    self._object_q.put(v)
+                self._route(events)
 
             except Empty:
                 pass
@@ -390,57 +601,343 @@ class EventProcessor(threading.Thread):
         self._stop_event.set()
         self._event_q.put(0)
 
+        for p in self._update_processors:
+            p.stop()
+
+    def join(self, timeout=None):
+        if not self._runtime:
+            super(EventProcessor, self).join(timeout)
+
 
 class TTLProcessor(threading.Thread):
-    def __init__(self):
+    def __init__(self, runtime=None):
         super(TTLProcessor, self).__init__()
 
+        self._wheel = TimerWheel(resolution=1.0)
+        self._cond = threading.Condition()
+
+        # object_id -> generation of the object when armed
+        self._generations = dict()
+
+        # on the shared runtime, expiry runs from a runtime timer set
+        # for the next deadline instead of this thread
+        self._runtime = runtime
+        self._timer = None
+
+        # the deadline the processor wakes up at, or None when idle.
+        # arming only compares against it, it may be earlier than the
+        # first deadline after a cancel.
+        self._next = None
+
         self.daemon = True
     
-        self.start()
+        if not runtime:
+            self.start()
+
+    def arm(self, object_id, ttl, generation=None):
+        with self._cond:
+            deadline = self._wheel.arm(object_id, time.time() + ttl)
+            self._generations[object_id] = generation
+
+            # wake up the processor if this is now the first deadline
+            if self._next is None or deadline < self._next:
+                self._next = deadline
+
+                if self._runtime:
+                    self._schedule(deadline)
+
+                else:
+                    self._cond.notify()
+
+    def cancel(self, object_id):
+        with self._cond:
+            self._wheel.cancel(object_id)
+            self._generations.pop(object_id, None)
+
+    def _schedule(self, deadline=None):
+        # caller holds the condition
+        if self._timer:
+            self._timer.cancel()
+
+        if deadline is None:
+            deadline = self._wheel.next_deadline()
+
+        self._next = deadline
+
+        if deadline is None:
+            self._timer = None
+            return
+
+        delay = max(deadline - time.time(), 0.0)
+
+        self._timer = self._runtime.call_later(delay, self._run_timer)
+
+    def _run_timer(self):
+        with self._cond:
+            self._timer = None
+
+        self._expire_due()
+
+        with self._cond:
+            if self._timer is None:
+                self._schedule()
+
+    def _expire(self, object_id, generation):
+        obj = KVObjectsManager._objects.get(object_id)
+
+        if obj is None or obj.is_originator():
+            return
+
+        # the TTL was reset after this arming, it has been armed again
+        if generation is not None and obj._ttl_generation != generation:
+            return
+
+        # reset without being armed, such as before we started
+        if obj._ttl_deadline is not None and obj._ttl_deadline > time.time():
+            KVObjectsManager._arm_ttl(obj)
+            return
+
+        logging.debug("Deleting expired object: %s" % (str(obj)))
+
+        # delete object
+        KVObjectsManager.delete(object_id)
+
+        dispatcher.send(signal=SIGNAL_EXPIRED_KVOBJECT, kvobject=obj)
+
+    def _expire_due(self):
+        with self._cond:
+            expired = [(object_id, self._generations.pop(object_id, None)) 
+                       for object_id in self._wheel.expire(time.time())]
+
+        for object_id, generation in expired:
+            try:
+                self._expire(object_id, generation)
+
+            except Exception as e:
+                logging.exception("TTLProcessor unexpected exception: %s", str(e))
 
     def run(self):
         while True:
-            time.sleep(10.0)        
-
-            # query for all objects
-            all_objects = KVObjectsManager.query(all=True)
+            with self._cond:
+                # sleep until something is armed
+                while len(self._wheel) == 0:
+                    self._next = None
+                    self._cond.wait()
 
-            # get list of remote objects
-            remote_objects = [o for o in all_objects if o.origin_id != origin.id]
+                self._next = self._wheel.next_deadline()
 
-            for obj in remote_objects:
-                # decrement time to live
-                obj._ttl -= 10
+                delay = self._next - time.time()
 
-                # check if expired
-                if obj._ttl < 0:
-                    logging.debug("Deleting expired object: %s" % (str(obj)))
+                # arming an earlier deadline wakes us up
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
 
-                    # delete object
-                    KVObjectsManager.delete(obj.object_id)
+            self._expire_due()
 
 
 class KVObjectsManager(object):
     _objects = dict()
+    _index = ObjectIndex()
+    _subscriptions = SubscriptionRegistry(_objects)
+    _versions = VersionTable()
+    # guards registry membership only, never held while taking object locks
+    _registry_lock = threading.RLock()
     _publisher = None
     _subscriber = None
     _requester = None
     _event_processor = None
     _ttl_processor = None
+    _runtime = None
+    _sync_sent = dict()
+    _collections = None
+    _snapshot = None
+    # a snapshot was loaded, so the first request for all objects
+    # can be skipped
+    _warm_start = False
     __lock = threading.RLock()
     _initialized = False
     
     @staticmethod
     def query(**kwargs):
-        with KVObjectsManager.__lock:
-            return [o for o in KVObjectsManager._objects.itervalues() if o.query(**kwargs)]
+        # the registry and index are read without the manager lock, so
+        # callers holding an object lock (such as the publisher) can
+        # query without risking a lock order inversion
+
+        # all trumps any other keywords
+        if kwargs.get("all"):
+            return KVObjectsManager._objects.values()
+
+        # a query without attribute comparisons matches nothing
+        if len([k for k in kwargs if k not in ["all", "expr", "contains"]]) == 0:
+            return []
+
+        candidates, exact = KVObjectsManager._index.plan(kwargs)
+
+        if candidates is None:
+            # no index applies, scan the registry
+            objects = KVObjectsManager._objects.values()
+            exact = False
+
+        else:
+            objects = [KVObjectsManager._objects.get(object_id) for object_id in candidates]
+            objects = [o for o in objects if o is not None]
+
+        if exact:
+            return objects
+
+        return [o for o in objects if o.query(**kwargs)]
+
+    @staticmethod
+    def query_async(**kwargs):
+        # returns a Future of the query result
+        return get_runtime().defer(KVObjectsManager.query, **kwargs)
+
+    @staticmethod
+    def add_index(attr):
+        with KVObjectsManager._registry_lock:
+            KVObjectsManager._index.create_index(attr, KVObjectsManager._objects.values())
+
+    @staticmethod
+    def drop_index(attr):
+        KVObjectsManager._index.drop_index(attr)
+
+    @staticmethod
+    def _add_object(obj):
+        with KVObjectsManager._registry_lock:
+            current = KVObjectsManager._objects.get(obj.object_id)
+
+            if current is obj:
+                return
+
+            if current is not None:
+                KVObjectsManager._index.remove(obj.object_id)
+
+            KVObjectsManager._objects[obj.object_id] = obj
+            KVObjectsManager._index.add(obj)
+
+        KVObjectsManager._versions.touch(obj.object_id, digest.collection_key(obj._attrs.get("collection")))
+        KVObjectsManager._subscriptions.object_added(obj)
+
+        if not obj.is_originator():
+            obj._ttl_deadline = time.time() + obj._ttl
+
+            KVObjectsManager._arm_ttl(obj)
+
+            if KVObjectsManager._snapshot:
+                KVObjectsManager._snapshot.mark(obj)
+
+    @staticmethod
+    def _remove_object(object_id):
+        with KVObjectsManager._registry_lock:
+            if object_id in KVObjectsManager._objects:
+                del KVObjectsManager._objects[object_id]
+                KVObjectsManager._index.remove(object_id)
+
+        KVObjectsManager._versions.remove(object_id)
+        KVObjectsManager._subscriptions.object_removed(object_id)
+
+        if KVObjectsManager._ttl_processor:
+            KVObjectsManager._ttl_processor.cancel(object_id)
+
+        if KVObjectsManager._snapshot:
+            KVObjectsManager._snapshot.mark_removed(object_id)
+
+    @staticmethod
+    def _arm_ttl(obj):
+        # objects added before the TTL processor starts only get a
+        # deadline, they are armed by _arm_pending()
+        obj._ttl_generation += 1
+
+        if KVObjectsManager._ttl_processor:
+            KVObjectsManager._ttl_processor.arm(obj.object_id, 
+                                                max(obj._ttl_deadline - time.time(), 0.0),
+                                                obj._ttl_generation)
+
+    @staticmethod
+    def _arm_pending():
+        for obj in KVObjectsManager._objects.values():
+            if not obj.is_originator() and obj._ttl_deadline is not None:
+                KVObjectsManager._arm_ttl(obj)
+
+    @staticmethod
+    def _object_changed(obj, key, value):
+        # only registered objects are indexed
+        if KVObjectsManager._objects.get(obj.object_id) is obj:
+            KVObjectsManager._index.update(obj.object_id, key, value)
+            KVObjectsManager._subscriptions.object_changed(obj, key)
+
+    @staticmethod
+    def _object_touched(obj):
+        if KVObjectsManager._objects.get(obj.object_id) is obj:
+            KVObjectsManager._versions.touch(obj.object_id, digest.collection_key(obj._attrs.get("collection")))
+
+            if KVObjectsManager._snapshot and not obj.is_originator():
+                KVObjectsManager._snapshot.mark(obj)
+
+    @staticmethod
+    def version():
+        # (version, modified time) of the whole registry
+        return KVObjectsManager._versions.version()
+
+    @staticmethod
+    def object_version(object_id):
+        # (version, modified time) of an object, None if unknown
+        return KVObjectsManager._versions.object_version(object_id)
+
+    @staticmethod
+    def collection_version(collection):
+        # (version, modified time) of a collection, None if unknown
+        return KVObjectsManager._versions.collection_version(digest.collection_key(collection))
+
+    @staticmethod
+    def add_subscription(criteria, keys, callback):
+        # routes received events with the given keys (None for any
+        # key) on objects matching criteria to callback
+        return KVObjectsManager._subscriptions.subscribe(criteria, keys, callback)
+
+    @staticmethod
+    def remove_subscription(sub):
+        KVObjectsManager._subscriptions.unsubscribe(sub)
+
+    @staticmethod
+    def match_subscriptions(event):
+        return KVObjectsManager._subscriptions.match(event)
+
+    @staticmethod
+    def get_view(criteria):
+        # live, incrementally maintained result set of a query.
+        # views are shared between identical queries.
+        return KVObjectsManager._subscriptions.get_view(criteria)
+
+    @staticmethod
+    def release_view(view):
+        KVObjectsManager._subscriptions.release_view(view)
+
+    @staticmethod
+    def _route_event(event):
+        KVObjectsManager._subscriptions.route(event)
 
     @staticmethod
     def get(object_id):
         with KVObjectsManager.__lock:
             return KVObjectsManager._objects[object_id]
 
+    @staticmethod
+    def lookup(object_id, collection=None):
+        # direct registry lookup, returns None if the object does not
+        # exist or is not in the given collection
+        obj = KVObjectsManager._objects.get(object_id)
+
+        if obj is None:
+            return None
+
+        if collection is not None and \
+           index_key(obj._attrs.get("collection")) != index_key(collection):
+            return None
+
+        return obj
+
     @staticmethod
     def start():
         with KVObjectsManager.__lock:
@@ -456,22 +953,122 @@ class KVObjectsManager(object):
 
             settings.init()
 
+            # on the shared runtime, event application, expiry and the
+            # periodic sync run as runtime tasks, leaving the broker
+            # publisher and subscriber as the only dedicated threads.
+            # they get workers of their own, so macros and processes
+            # on the shared runtime can't delay them.
+            runtime = None
+
+            if settings.SHARED_RUNTIME:
+                runtime = Runtime(workers=settings.MANAGER_RUNTIME_WORKERS)
+
+            KVObjectsManager._runtime = runtime
+
             KVObjectsManager._publisher         = Publisher(KVObjectsManager)
+            KVObjectsManager._sender            = ObjectSender(KVObjectsManager, runtime=runtime)
+            KVObjectsManager._event_processor   = EventProcessor(runtime=runtime)
+            KVObjectsManager._ttl_processor     = TTLProcessor(runtime=runtime)
+
+            # objects received before the TTL processor existed
+            KVObjectsManager._arm_pending()
+
+            # loaded objects need the TTL processor, and must be in
+            # the registry before the subscriber asks for objects
+            if settings.OBJECT_SNAPSHOT:
+                KVObjectsManager._load_snapshot()
+
             KVObjectsManager._subscriber        = Subscriber(KVObjectsManager)
-            KVObjectsManager._sender            = ObjectSender(KVObjectsManager)
-            KVObjectsManager._event_processor   = EventProcessor()
-            KVObjectsManager._ttl_processor     = TTLProcessor()
 
             origin_obj = KVObject(collection="origin")
 
             import socket
             origin_obj.hostname = socket.gethostname()
 
+            # advertise which wire codecs we can decode
+            origin_obj.codecs = json_codec.available_codecs()
+
             origin_obj.notify()
         
 
+    @staticmethod
+    def _load_snapshot():
+        snapshot = RegistrySnapshot(runtime=KVObjectsManager._runtime)
+
+        start = time.time()
+        count = 0
+
+        for d in snapshot.load():
+            obj = KVObject().from_dict(d)
+
+            if obj.is_originator() or \
+               not KVObjectsManager.is_subscribed(obj._attrs.get("collection")):
+                continue
+
+            # until confirmed by a digest, sync or update from its
+            # origin, or expired by TTL
+            obj._stale = True
+
+            KVObjectsManager._add_object(obj)
+            count += 1
+
+        logging.info("Loaded %d objects from snapshot in %.3f s" % (count, time.time() - start))
+
+        # objects loaded above are already saved
+        KVObjectsManager._snapshot = snapshot
+        KVObjectsManager._warm_start = count > 0
+
+        snapshot.start()
+
+    @staticmethod
+    def subscribe(collections=None):
+        # declares which collections this process cares about, the
+        # subscriber then only listens to their channels.
+        # None subscribes to all collections.
+        if collections is not None:
+            if isinstance(collections, basestring):
+                collections = [collections]
+
+            collections = set([digest.collection_key(c) for c in collections])
+
+            # peers advertise themselves in the origin collection
+            collections.add("origin")
+
+        KVObjectsManager._collections = collections
+
+        # drop remote objects we are no longer interested in
+        for obj in KVObjectsManager.query(all=True):
+            if not obj.is_originator() and \
+               not KVObjectsManager.is_subscribed(obj._attrs.get("collection")):
+                KVObjectsManager.delete(obj.object_id)
+
+        if KVObjectsManager._subscriber:
+            KVObjectsManager._subscriber.update_subscriptions()
+
+    @staticmethod
+    def subscribed_collections():
+        if KVObjectsManager._collections is None:
+            return None
+
+        return sorted(KVObjectsManager._collections)
+
+    @staticmethod
+    def is_subscribed(collection):
+        if KVObjectsManager._collections is None:
+            return True
+
+        return digest.collection_key(collection) in KVObjectsManager._collections
+
     @staticmethod
     def request_objects():
+        # after a warm start, digests from each origin bring the
+        # snapshot up to date, without every node republishing
+        if KVObjectsManager._warm_start:
+            KVObjectsManager._warm_start = False
+
+            logging.debug("Skipping request for objects after warm start")
+            return
+
         logging.debug("Requesting objects...")
         KVObjectsManager._publisher.publish_method("request_objects")
 
@@ -482,6 +1079,86 @@ class KVObjectsManager(object):
             for o in KVObjectsManager._objects.itervalues():
                 o.put()
 
+    @staticmethod
+    def publish_digest():
+        local_objects = KVObjectsManager.query(origin_id=origin.id)
+
+        data = {"collections": digest.compute(local_objects)}
+
+        KVObjectsManager._publisher.publish_method("digest", data)
+
+    @staticmethod
+    def receive_digest(origin_id, data):
+        remote_objects = KVObjectsManager.query(origin_id=origin_id)
+
+        # the digest doubles as the heartbeat for the origin's objects
+        for obj in remote_objects:
+            obj._reset_ttl()
+
+        remote_digest = dict((k, v) for k, v in data["collections"].iteritems() 
+                             if KVObjectsManager.is_subscribed(k))
+
+        changed, removed = digest.diff(digest.compute(remote_objects), remote_digest)
+
+        # objects in collections that match are confirmed
+        for obj in remote_objects:
+            collection = digest.collection_key(obj._attrs.get("collection"))
+
+            if collection not in changed and collection not in removed:
+                obj._stale = False
+
+        # collections the origin no longer has
+        for obj in remote_objects:
+            if digest.collection_key(obj._attrs.get("collection")) in removed:
+                KVObjectsManager.delete(obj.object_id)
+
+        if len(changed) > 0:
+            logging.debug("Requesting sync of %s from: %s" % (changed, origin_id))
+
+            KVObjectsManager._publisher.publish_method("sync_request", 
+                                                       {"origin_id": origin_id,
+                                                        "collections": changed})
+
+    @staticmethod
+    def publish_collections(collections):
+        local_objects = KVObjectsManager.query(origin_id=origin.id)
+
+        now = time.time()
+
+        for collection in collections:
+            # several peers will usually ask for the same collection
+            # at the same time, answer only once
+            if now - KVObjectsManager._sync_sent.get(collection, 0) < _SYNC_HOLDOFF:
+                continue
+
+            KVObjectsManager._sync_sent[collection] = now
+
+            objects = [o for o in local_objects 
+                       if digest.collection_key(o._attrs.get("collection")) == collection]
+
+            KVObjectsManager._publisher.publish_method("sync", 
+                                                       {"collection": collection,
+                                                        "objects": objects},
+                                                       channel=collection_channel(collection))
+
+    @staticmethod
+    def receive_sync(origin_id, data):
+        if not KVObjectsManager.is_subscribed(data["collection"]):
+            return
+
+        object_ids = set()
+
+        for d in data["objects"]:
+            object_ids.add(d["object_id"])
+
+            KVObjectsManager.update(d)
+
+        # remove objects the origin no longer has in this collection
+        for obj in KVObjectsManager.query(origin_id=origin_id):
+            if obj.object_id not in object_ids and \
+               digest.collection_key(obj._attrs.get("collection")) == data["collection"]:
+                KVObjectsManager.delete(obj.object_id)
+
     @staticmethod
     def unpublish_objects():
         with KVObjectsManager.__lock:
@@ -496,24 +1173,34 @@ class KVObjectsManager(object):
 
                 logging.debug("Deleted object: %s" % (str(obj)))
 
-                del KVObjectsManager._objects[object_id]
+                KVObjectsManager._remove_object(object_id)
           
     @staticmethod
     def update(data):
         # reconstruct object
         obj = KVObject().from_dict(data)
+
+        # nodes without channel routing send everything on one channel
+        if not KVObjectsManager.is_subscribed(obj._attrs.get("collection")):
+            return
     
         if obj.object_id in KVObjectsManager._objects:
-            # update object
-            KVObjectsManager._objects[obj.object_id].batch_update(obj._attrs)
+            existing = KVObjectsManager._objects[obj.object_id]
+
+            with existing._lock:
+                # update object, the originator's timestamp is authoritative
+                existing.batch_update(obj._attrs, timestamp=obj.updated_at)
+                existing.updated_at = obj.updated_at
 
             # reset time to live
-            KVObjectsManager._objects[obj.object_id]._reset_ttl()
+            existing._reset_ttl()
+
+            existing._stale = False
 
         else:
             with KVObjectsManager.__lock:
                 # add new object
-                KVObjectsManager._objects[obj.object_id] = obj
+                KVObjectsManager._add_object(obj)
                 logging.debug("Received new object: %s" % (str(obj)))
 
     @staticmethod
@@ -526,7 +1213,12 @@ class KVObjectsManager(object):
         for event in events:
             if not isinstance(event, KVEvent):
                 # build event object from dictionary
-                event = KVEvent().from_dict(event)
+                event = KVEvent.from_dict(event)
+
+                # skip events for objects we don't have, such as
+                # objects in collections we are not subscribed to
+                if event.object_id not in KVObjectsManager._objects:
+                    continue
 
                 # attach object to event
                 event.kvobject = KVObjectsManager._objects[event.object_id]
@@ -536,13 +1228,101 @@ class KVObjectsManager(object):
         # post list of events to processor
         KVObjectsManager._event_processor.post_events(events_temp)
 
+    @staticmethod
+    def put_objects(objects):
+        # put() for many objects, in a single publish
+        msgs = list()
+
+        for obj in objects:
+            with obj._lock:
+                if not obj.is_originator():
+                    continue
+
+                channel, previous = obj._move_channel()
+
+                if previous is not None:
+                    msgs.append(("delete", obj, previous))
+
+                msgs.append(("publish", obj, channel))
+
+                KVObjectsManager._add_object(obj)
+
+        try:
+            KVObjectsManager._publisher.publish_many(msgs)
+
+        except AttributeError:
+            # publisher not running
+            pass
+
+    @staticmethod
+    def notify_objects(objects):
+        # notify() for many objects, new objects and events each go
+        # out in a single publish
+        new_objects = list()
+        events = list()
+
+        for obj in objects:
+            obj.updated_at = datetime.utcnow()
+
+            if obj.object_id not in KVObjectsManager._objects:
+                new_objects.append(obj)
+
+        if len(new_objects) > 0:
+            KVObjectsManager.put_objects(new_objects)
+
+        for obj in objects:
+            events.extend(obj._take_events())
+
+        try:
+            if len(events) > 0:
+                KVObjectsManager.send_events(events)
+
+        except AttributeError:
+            # publisher not running
+            pass
+
     @staticmethod
     def send_events(events):
         # check if events is iterable
         if not isinstance(events, collections.Sequence):
             events = [events]
 
-        KVObjectsManager._publisher.publish_method("events", events)
+        # group events by the channel of their object
+        channels = collections.OrderedDict()
+
+        # objects that moved to another collection are deleted on the
+        # old channel and published in full on the new one, before
+        # their events
+        moves = list()
+        moved = set()
+
+        for event in events:
+            obj = KVObjectsManager._objects.get(event.object_id)
+
+            if obj is None:
+                channel = collection_channel(None)
+
+            elif obj.is_originator() and obj.object_id not in moved:
+                with obj._lock:
+                    channel, previous = obj._move_channel()
+
+                if previous is not None:
+                    moves.append(("delete", obj, previous))
+                    moves.append(("publish", obj, channel))
+
+                moved.add(obj.object_id)
+
+            else:
+                channel = object_channel(obj)
+
+            if channel not in channels:
+                channels[channel] = list()
+
+            channels[channel].append(event)
+
+        # all channels go out in one publish
+        KVObjectsManager._publisher.publish_many(moves + [("events", channel_events, channel) 
+                                                          for channel, channel_events in channels.iteritems()])
 
         for event in events:
             event.send()
@@ -572,6 +1352,15 @@ class KVObjectsManager(object):
         KVObjectsManager._sender.stop()
         KVObjectsManager._event_processor.stop()
 
+        # once nothing is received or applied, so the last changes
+        # are in the snapshot
+        if KVObjectsManager._snapshot:
+            KVObjectsManager._snapshot.close()
+            KVObjectsManager._snapshot = None
+
+        if KVObjectsManager._runtime:
+            KVObjectsManager._runtime.stop()
+
     @staticmethod
     def join():        
         KVObjectsManager._publisher.join()
@@ -579,6 +1368,13 @@ class KVObjectsManager(object):
         KVObjectsManager._sender.join()
         KVObjectsManager._event_processor.join()
 
+        if KVObjectsManager._runtime:
+            KVObjectsManager._runtime.join()
+
+
+# one receiver routes every received event to its subscriptions
+dispatcher.connect(KVObjectsManager._route_event, signal=SIGNAL_RECEIVED_KVEVENT)
+
 
 def start():
     KVObjectsManager.start()
@@ -589,3 +1385,8 @@ def stop():
 def query(**kwargs):
     return KVObjectsManager.query(**kwargs)
 
+def query_async(**kwargs):
+    return KVObjectsManager.query_async(**kwargs)
+
+def subscribe(collections=None):
+    KVObjectsManager.subscribe(collections)
@@ -12,28 +12,23 @@
 
 from sapphire.core import *
 
-from pydispatch import dispatcher
-from Queue import Queue, Empty
+from runtime import Runtime, Mailbox, Future, get_runtime
+
+from Queue import Queue, Empty, Full
 import logging
 import threading
-import time
 import collections
 
 
 
-class _KVProcessRunner(threading.Thread):
-    def __init__(self, process=None):
-        super(_KVProcessRunner, self).__init__()
-
-        self._process = process
-
-        self.daemon = True
-
-    def run(self):
-        self._process._run()
-
-
 class KVProcess(KVObject):
+    # loop() usually blocks, in wait() or receive_event(). such
+    # processes run on a thread of their own, so they can't starve the
+    # shared runtime. set to False in processes whose loop() returns
+    # the delay to the next iteration instead, and uses
+    # receive_event_async(), to run them on the shared runtime.
+    blocking_loop = True
+
     def __init__(self, name=None, **kwargs):
         super(KVProcess, self).__init__(collection="processes", **kwargs)
 
@@ -42,49 +37,111 @@ class KVProcess(KVObject):
         self._stop_event = threading.Event()
         self._stop_event.set()
 
-        self.running = False
         self._killed = False
+        self._finished = threading.Event()
 
-        self._event_q = None
+        # incremented on every start, so loop iterations left over from
+        # an earlier run end themselves
+        self._generation = 0
+
+        # setup, loop iterations and shutdown run one at a time, in
+        # order, on the shared runtime or a thread of our own. the
+        # thread is only started with the process.
+        self._runtime = None
 
-        # connect to event dispatcher
-        dispatcher.connect(self._receive_event, signal=SIGNAL_RECEIVED_KVEVENT)
+        if self._has_loop() and self.blocking_loop:
+            self._runtime = Runtime(workers=1)
 
-        self._runner = _KVProcessRunner(self)
-        self._runner.start()
+        self._mailbox = Mailbox(self._run_task, self._runtime)
+
+        self.running = False
+
+        self._event_q = None
+        self._event_lock = threading.Lock()
+        self._event_waiters = collections.deque()
+        self._subscription = None
 
     def _receive_event(self, event):
-        if self._event_q:
-            self._event_q.put(event)
+        # called from the event apply threads, so this must never block.
+        # if the process is not keeping up, drop its oldest event.
+        with self._event_lock:
+            # hand the event to a waiting receive_event_async first
+            while len(self._event_waiters) > 0:
+                if self._event_waiters.popleft().set_result(event):
+                    return
+
+            while True:
+                try:
+                    self._event_q.put_nowait(event)
+                    return
 
-    def receive_event(self, source=Query(all=True), keys=[], timeout=1.0):
+                except Full:
+                    try:
+                        self._event_q.get_nowait()
+
+                    except Empty:
+                        pass
+
+    def _subscribe(self, source, keys):
         if not self._event_q:
             self._event_q = Queue(maxsize=256)
 
-        if not isinstance(keys, collections.Iterable):
+        if isinstance(keys, basestring) or not isinstance(keys, collections.Iterable):
             keys = [keys]
 
-        while True:
-            event = self._event_q.get(True, timeout=timeout)
+        keys = list(keys)
+        criteria = source.criteria
+
+        # only events on objects matching the source with one of the
+        # given keys are routed to this process
+        if self._subscription:
+            if self._subscription.view.criteria == criteria and \
+               self._subscription.keys == keys:
+                return
+
+            KVObjectsManager.remove_subscription(self._subscription)
+
+        self._subscription = KVObjectsManager.add_subscription(criteria, keys, self._receive_event)
+
+    def receive_event(self, source=Query(all=True), keys=[], timeout=1.0):
+        self._subscribe(source, keys)
+
+        return self._event_q.get(True, timeout=timeout)
+
+    def receive_event_async(self, source=Query(all=True), keys=[], timeout=None):
+        # returns a Future of the next event, without holding a thread
+        # while waiting. on timeout the future raises Empty, like
+        # receive_event.
+        self._subscribe(source, keys)
+
+        future = Future()
 
-            # filter event
-            if event.object_id not in [o.object_id for o in source()]:
-                continue
+        with self._event_lock:
+            try:
+                future.set_result(self._event_q.get_nowait())
 
-            if event.key not in keys:
-                continue
+                return future
 
-            return event
+            except Empty:
+                self._event_waiters.append(future)
+
+        if timeout is not None:
+            get_runtime().call_later(timeout, future.set_exception, Empty())
+
+        return future
 
     def start(self):
         if self.is_running():
             raise RuntimeError("KVProcess already running")
 
         self._stop_event.clear()
+        self._generation += 1
 
         self.running = True
         self.notify()
 
+        self._mailbox.post((self._run_setup, self._generation))
+
     def stop(self):
         if not self.is_running():
             raise RuntimeError("KVProcess not running")            
@@ -93,6 +150,8 @@ class KVProcess(KVObject):
         self.running = False
         self.notify()
 
+        self._mailbox.post((self._run_shutdown,))
+
     def is_running(self):
         return not self._stop_event.is_set()
 
@@ -105,57 +164,110 @@ class KVProcess(KVObject):
     def shutdown(self):
         pass
 
-    def _run(self):
-        # NOT running loop
-        # wait until start() or self.running == True
-        while not self._killed:
-            while not self.is_running() and not self._killed:
-                time.sleep(1.0)
+    def set(self, key, value, timestamp=None):
+        super(KVProcess, self).set(key, value, timestamp=timestamp)
 
-                if self.running:
-                    try:
-                        self.start()
+        if key == "running":
+            self._running_changed()
 
-                    except RuntimeError:
-                        pass
+    def batch_update(self, updates, timestamp=None):
+        super(KVProcess, self).batch_update(updates, timestamp=timestamp)
 
-            # process init
-            self.setup()
-            self.notify()
+        if "running" in updates:
+            self._running_changed()
 
-            # run loop
-            # runs until stop() or self.running == False
-            while self.is_running():
-                try:
-                    self.loop()
+    def _running_changed(self):
+        # running can be changed from outside, such as through the
+        # api server, which starts or stops the process right away
+        if self._killed:
+            return
 
-                # pass on queue empty exception
-                except Empty:
-                    pass
+        try:
+            if self.running and not self.is_running():
+                self.start()
 
-                if not self.running:
-                    try:
-                        self.stop()
+            elif not self.running and self.is_running():
+                self.stop()
 
-                    except RuntimeError:
-                        pass
+        except RuntimeError:
+            pass
+
+    def _run_task(self, task):
+        task[0](*task[1:])
+
+    def _has_loop(self):
+        # processes that don't override loop() have nothing to run
+        # between start and stop, and don't use the runtime at all
+        return type(self).loop.__func__ is not KVProcess.loop.__func__
+
+    def _run_setup(self, generation):
+        self.setup()
+        self.notify()
+
+        if self._has_loop():
+            self._run_loop(generation)
 
-            # process shutdown
-            self.shutdown()
-            self.notify()
+    def _run_loop(self, generation):
+        # runs one iteration of loop(), then queues the next.
+        # loop() may return a delay in seconds to wait before the next
+        # iteration without holding a runtime worker.
+        if not self.is_running() or generation != self._generation:
+            return
+
+        delay = None
+
+        try:
+            delay = self.loop()
+
+        # pass on queue empty exception
+        except Empty:
+            pass
+
+        if not self.running:
+            try:
+                self.stop()
+
+            except RuntimeError:
+                pass
+
+            return
+
+        if delay:
+            (self._runtime or get_runtime()).call_later(delay, self._mailbox.post, (self._run_loop, generation))
+
+        else:
+            self._mailbox.post((self._run_loop, generation))
+
+    def _run_shutdown(self):
+        self.shutdown()
+        self.notify()
 
     def loop(self):
-        self.wait(1.0)
+        return 1.0
         
     def join(self, timeout=60.0):
-        self._runner.join(timeout)
+        # returns once the process has been killed and shut down
+        self._finished.wait(timeout)
 
     def kill(self):
         self._killed = True
 
+        if self._subscription:
+            KVObjectsManager.remove_subscription(self._subscription)
+            self._subscription = None
+
         if self.is_running():
             self.stop()
 
+        self._mailbox.post((self._finish,))
+
+    def _finish(self):
+        self._finished.set()
+
+        # lets our thread exit once this task returns
+        if self._runtime:
+            self._runtime.stop()
+
 
 if __name__ == "__main__":
 
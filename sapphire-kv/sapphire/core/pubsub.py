@@ -11,6 +11,7 @@
 #
 
 import threading
+import collections
 import time
 
 from Queue import Queue, Empty
@@ -18,14 +19,74 @@ import logging
 import uuid
 import datetime
 import socket
+import zlib
 
 import origin
 
 import redis
 import json_codec
+import digest
 from sapphire.core import settings
 
 
+# control messages and traffic from nodes without channel routing
+BASE_CHANNEL = "sapphire_objects"
+
+
+def _escape_pattern(s):
+    for c in "\\*?[]":
+        s = s.replace(c, "\\" + c)
+
+    return s
+
+def shard_for(object_id, shards):
+    if isinstance(object_id, unicode):
+        object_id = object_id.encode("utf-8")
+
+    # crc32 is stable across processes, unlike hash()
+    return (zlib.crc32(object_id) & 0xffffffff) % shards
+
+def collection_channel(collection, object_id=None):
+    if not settings.OBJECT_CHANNEL_ROUTING:
+        return BASE_CHANNEL
+
+    key = digest.collection_key(collection)
+
+    # length prefixed, so a ":" in a collection name can't be taken
+    # for a shard: "foo:1" is "sapphire_objects:5:foo:1", while "foo"
+    # shard 1 is "sapphire_objects:3:foo:1"
+    channel = "%s:%d:%s" % (BASE_CHANNEL, len(key), key)
+
+    if object_id is not None and settings.OBJECT_CHANNEL_SHARDS > 1:
+        channel = "%s:%d" % (channel, shard_for(object_id, settings.OBJECT_CHANNEL_SHARDS))
+
+    return channel
+
+def object_channel(obj):
+    return collection_channel(obj._attrs.get("collection"), obj.object_id)
+
+def subscription_channels(collections):
+    # returns (channels, patterns) to subscribe to for the given
+    # collections, None meaning all collections
+    channels = [BASE_CHANNEL]
+    patterns = list()
+
+    if not settings.OBJECT_CHANNEL_ROUTING:
+        return channels, patterns
+
+    if collections is None:
+        patterns.append("%s:*" % (BASE_CHANNEL))
+
+    else:
+        for collection in collections:
+            channels.append(collection_channel(collection))
+
+            if settings.OBJECT_CHANNEL_SHARDS > 1:
+                patterns.append("%s:*" % (_escape_pattern(collection_channel(collection))))
+
+    return channels, patterns
+
+
 class Publisher(threading.Thread):
     def __init__(self, object_manager):
         super(Publisher, self).__init__()
@@ -35,15 +96,128 @@ class Publisher(threading.Thread):
 
         self.client = redis.Redis(settings.BROKER_HOST)
 
+        self._codec = json_codec.get_codec("json")
+        self._codec_checked = 0
+
         self._running = True
         self.start()
 
-    def publish_method(self, method, data=None):
+    def _select_codec(self):
+        now = time.time()
+
+        if now - self._codec_checked < 1.0:
+            return self._codec
+
+        self._codec_checked = now
+
+        name = "json"
+
+        # only switch to the preferred codec once every peer we know
+        # of has advertised that it can decode it
+        if settings.WIRE_CODEC != "json" and \
+           settings.WIRE_CODEC in json_codec.available_codecs():
+
+            peers = [o for o in self.object_manager.query(collection="origin") 
+                     if o.origin_id != origin.id]
+
+            if len(peers) > 0 and \
+               all([settings.WIRE_CODEC in (o._attrs.get("codecs") or []) for o in peers]):
+                name = settings.WIRE_CODEC
+
+        if name != self._codec.name:
+            logging.info("ObjectPublisher switching to codec: %s" % (name))
+
+        self._codec = json_codec.get_codec(name)
+
+        return self._codec
+
+    def publish_method(self, method, data=None, channel=BASE_CHANNEL):
         msg = {"method": method,
                "origin_id": origin.id,
                "data": data}
 
-        self._queue.put(json_codec.Encoder().encode(msg))
+        codec = self._select_codec()
+
+        self._queue.put((channel, codec, codec.encode(msg)))
+
+    def publish_many(self, methods):
+        # queues a list of (method, data, channel) as one item, so they
+        # go out in one round trip with one framed message per channel
+        codec = self._select_codec()
+        channels = collections.OrderedDict()
+
+        for method, data, channel in methods:
+            msg = {"method": method,
+                   "origin_id": origin.id,
+                   "data": data}
+
+            channels.setdefault(channel, list()).append((channel, codec, codec.encode(msg)))
+
+        msgs = list()
+
+        for channel_msgs in channels.itervalues():
+            msgs.extend(channel_msgs)
+
+        if len(msgs) > 0:
+            self._queue.put(msgs)
+
+    def _get_batch(self):
+        # block for the first message, then drain whatever else is
+        # queued up to the batch size, lingering for the batch window.
+        # lists queued by publish_many are never split.
+        msgs = list()
+        item = self._queue.get()
+
+        deadline = time.time() + settings.PUBLISH_BATCH_WINDOW
+
+        while True:
+            if isinstance(item, list):
+                msgs.extend(item)
+
+            elif item:
+                msgs.append(item)
+
+            # stop requests are filtered out
+
+            if len(msgs) >= settings.PUBLISH_BATCH_SIZE:
+                break
+
+            try:
+                timeout = deadline - time.time()
+
+                if timeout > 0:
+                    item = self._queue.get(True, timeout)
+
+                else:
+                    item = self._queue.get(block=False)
+
+            except Empty:
+                break
+
+        return msgs
+
+    def _send_batch(self, msgs):
+        # split into runs of messages with the same channel and codec,
+        # the codec may have changed while they were queued
+        runs = list()
+
+        for channel, codec, data in msgs:
+            if len(runs) == 0 or runs[-1][0] != channel or runs[-1][1] is not codec:
+                runs.append((channel, codec, list()))
+
+            runs[-1][2].append(data)
+
+        # send all frames in one round trip
+        pipe = self.client.pipeline(transaction=False)
+
+        for channel, codec, run in runs:
+            if len(run) == 1:
+                pipe.publish(channel, run[0])
+
+            else:
+                pipe.publish(channel, codec.frame_batch(origin.id, run))
+
+        pipe.execute()
 
     def run(self):
         logging.info("ObjectPublisher started, server: %s" % (settings.BROKER_HOST))
@@ -51,9 +225,7 @@ class Publisher(threading.Thread):
         try:
             while self._running or not self._queue.empty():
                 try:
-                    o = self._queue.get()
-
-                    self.client.publish("sapphire_objects", o)
+                    self._send_batch(self._get_batch())
 
                 except redis.ConnectionError as e:
                     # check if stop was requested
@@ -89,6 +261,9 @@ class Subscriber(threading.Thread):
         self.subscriber = self.client.pubsub()
         self.object_manager = object_manager
 
+        self._channels = list()
+        self._patterns = list()
+
         self._running = True
         self.start()
 
@@ -100,7 +275,11 @@ class Subscriber(threading.Thread):
                 return
             
             # check methods
-            if msg["method"] == "publish":
+            if msg["method"] == "batch":
+                for m in msg["data"]:
+                    self._process_msg(m)
+
+            elif msg["method"] == "publish":
                 self.object_manager.update(msg["data"])
             
             elif msg["method"] == "events":
@@ -113,23 +292,74 @@ class Subscriber(threading.Thread):
                 logging.debug("Received request for objects")
                 self.object_manager.publish_objects()
 
+            elif msg["method"] == "digest":
+                self.object_manager.receive_digest(msg["origin_id"], msg["data"])
+
+            elif msg["method"] == "sync_request":
+                if msg["data"]["origin_id"] == origin.id:
+                    logging.debug("Received sync request for: %s" % (msg["data"]["collections"]))
+                    self.object_manager.publish_collections(msg["data"]["collections"])
+
+            elif msg["method"] == "sync":
+                self.object_manager.receive_sync(msg["origin_id"], msg["data"])
+
         except TypeError:
             pass
         
+    def update_subscriptions(self):
+        channels, patterns = subscription_channels(self.object_manager.subscribed_collections())
+
+        new_channels = [c for c in channels if c not in self._channels]
+        new_patterns = [p for p in patterns if p not in self._patterns]
+        old_channels = [c for c in self._channels if c not in channels]
+        old_patterns = [p for p in self._patterns if p not in patterns]
+
+        if len(new_channels) > 0:
+            self.subscriber.subscribe(*new_channels)
+
+        if len(new_patterns) > 0:
+            self.subscriber.psubscribe(*new_patterns)
+
+        if len(old_channels) > 0:
+            self.subscriber.unsubscribe(*old_channels)
+
+        if len(old_patterns) > 0:
+            self.subscriber.punsubscribe(*old_patterns)
+
+        self._channels = channels
+        self._patterns = patterns
+
+        logging.debug("ObjectSubscriber channels: %s patterns: %s" % (channels, patterns))
+
     def run(self):
         logging.info("ObjectSubscriber started, server: %s" % (settings.BROKER_HOST))
 
         try:
             while self._running:
                 try:
-                    self.subscriber.subscribe("sapphire_objects")
+                    # subscribe from scratch after a reconnect
+                    self._channels = list()
+                    self._patterns = list()
+                    self.update_subscriptions()
+
                     self.object_manager.request_objects()
 
                     for msg in self.subscriber.listen():
-                        if msg["type"] != "message":
+                        if msg["type"] not in ["message", "pmessage"]:
                             continue
-                        
-                        self._process_msg(json_codec.Decoder().decode(msg["data"]))
+
+                        # a message we can't read, such as in a codec we
+                        # don't have, is dropped. leaving the loop would
+                        # subscribe again and ask every node for all of
+                        # its objects.
+                        try:
+                            data = json_codec.decode(msg["data"])
+
+                        except Exception as e:
+                            logging.warning("ObjectSubscriber dropped message on %s: %s", msg.get("channel"), str(e))
+                            continue
+
+                        self._process_msg(data)
 
                 except redis.ConnectionError:
                     logging.info("Unable to connect to server, retrying...")
@@ -151,32 +381,60 @@ class Subscriber(threading.Thread):
         
         try:
             self.subscriber.unsubscribe()
+            self.subscriber.punsubscribe()
 
         except redis.ConnectionError:
             pass
             
 
 class ObjectSender(threading.Thread):
-    def __init__(self, object_manager):
+    def __init__(self, object_manager, runtime=None):
         super(ObjectSender, self).__init__()
 
         self.object_manager = object_manager
 
         self._stop_event = threading.Event()
-        self.start()
+
+        # on the shared runtime, each send is a timer task
+        self._runtime = runtime
+        self._timer = None
+
+        if runtime:
+            self._schedule()
+
+        else:
+            self.start()
+
+    def _schedule(self):
+        self._timer = self._runtime.call_later(settings.OBJECT_PUBLISH_RATE, self._run_timer)
+
+    def _run_timer(self):
+        if self._stop_event.is_set():
+            return
+
+        self._send()
+        self._schedule()
+
+    def _send(self):
+        try:
+            if settings.OBJECT_ANTI_ENTROPY:
+                # publish a digest, peers request what differs
+                self.object_manager.publish_digest()
+
+            else:
+                self.object_manager.publish_objects()
+
+        except Exception as e:
+            logging.exception("ObjectRequester unexpected exception: %s", str(e))
 
     def run(self):
         logging.info("ObjectRequester started")
 
         try:
             while not self._stop_event.is_set():
-                try:
-                    self._stop_event.wait(settings.OBJECT_PUBLISH_RATE)
-
-                    self.object_manager.publish_objects()
+                self._stop_event.wait(settings.OBJECT_PUBLISH_RATE)
 
-                except Exception as e:
-                    logging.exception("ObjectRequester unexpected exception: %s", str(e))
+                self._send()
 
         except Exception as e:
             logging.critical("ObjectRequester failed with: %s", str(e))
@@ -185,7 +443,10 @@ class ObjectSender(threading.Thread):
 
     def stop(self):
         self._stop_event.set()
-        
-
 
+        if self._timer:
+            self._timer.cancel()
 
+    def join(self, timeout=None):
+        if not self._runtime:
+            super(ObjectSender, self).join(timeout)
@@ -12,15 +12,43 @@
 
 from sapphire.core import KVObjectsManager
 
+import threading
+
+
 class Query(object):
     def __init__(self, **kwargs):
         super(Query, self).__init__()
 
         self.criteria = kwargs
 
+        self._view = None
+        self._view_lock = threading.Lock()
+
     def __str__(self):
         s = "Query: %s" % (self.criteria)
         return s
 
     def __call__(self):
+        if self._view:
+            return self._view.objects()
+
         return KVObjectsManager.query(**self.criteria)
+
+    def __contains__(self, object_id):
+        return object_id in self.view()
+
+    def view(self):
+        # the live view is created on first use and kept up to date by
+        # the object manager, so membership tests don't run the query
+        if self._view is None:
+            with self._view_lock:
+                if self._view is None:
+                    self._view = KVObjectsManager.get_view(self.criteria)
+
+        return self._view
+
+    def release(self):
+        with self._view_lock:
+            if self._view:
+                KVObjectsManager.release_view(self._view)
+                self._view = None
@@ -0,0 +1,349 @@
+#
+# <license>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+# 
+# 
+# Copyright 2013 Sapphire Open Systems
+#  
+# </license>
+#
+
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+import settings
+
+
+class Timer(object):
+    def __init__(self, deadline, fn, args, kwargs):
+        super(Timer, self).__init__()
+
+        self.deadline = deadline
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimeoutError(Exception):
+    pass
+
+
+class Future(object):
+    # result of a task run on the runtime, or of anything else that
+    # completes later
+    def __init__(self):
+        super(Future, self).__init__()
+
+        self._cond = threading.Condition()
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = list()
+
+    def done(self):
+        return self._done
+
+    def _complete(self, result, exception):
+        with self._cond:
+            if self._done:
+                return False
+
+            self._result = result
+            self._exception = exception
+            self._done = True
+
+            self._cond.notify_all()
+
+            callbacks = self._callbacks
+            self._callbacks = list()
+
+        for fn in callbacks:
+            try:
+                fn(self)
+
+            except Exception as e:
+                logging.exception("Future callback %s raised exception: %s", fn, str(e))
+
+        return True
+
+    def set_result(self, result):
+        # returns False if the future was already done
+        return self._complete(result, None)
+
+    def set_exception(self, exception):
+        return self._complete(None, exception)
+
+    def add_done_callback(self, fn):
+        with self._cond:
+            if not self._done:
+                self._callbacks.append(fn)
+                return
+
+        fn(self)
+
+    def exception(self, timeout=None):
+        with self._cond:
+            if not self._done:
+                self._cond.wait(timeout)
+
+            if not self._done:
+                raise TimeoutError
+
+            return self._exception
+
+    def result(self, timeout=None):
+        exception = self.exception(timeout)
+
+        if exception is not None:
+            raise exception
+
+        return self._result
+
+
+class Runtime(object):
+    # a bounded pool of worker threads running short tasks.
+    # workers are started on demand, and sleep on a condition variable
+    # until a task is submitted or a timer is due, so idle tasks cost
+    # no threads and wakeups are immediate.
+    def __init__(self, workers=None):
+        super(Runtime, self).__init__()
+
+        if workers is None:
+            workers = settings.RUNTIME_WORKERS
+
+        self.max_workers = workers
+
+        self._cond = threading.Condition()
+        self._ready = collections.deque()
+        self._timers = list()
+        self._seq = itertools.count()
+        self._workers = list()
+        self._idle = 0
+        self._stopped = False
+
+        self.tasks_run = 0
+
+    def _spawn(self):
+        # caller holds the condition.
+        # start a worker if there are more ready tasks than idle
+        # workers. any worker also waits for the timers.
+        if len(self._workers) >= self.max_workers:
+            return
+
+        if len(self._workers) > 0 and len(self._ready) <= self._idle:
+            return
+
+        worker = threading.Thread(target=self._work)
+        worker.daemon = True
+        worker.start()
+
+        self._workers.append(worker)
+
+    def submit(self, fn, *args, **kwargs):
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("Runtime stopped")
+
+            self._ready.append((fn, args, kwargs))
+
+            self._spawn()
+            self._cond.notify()
+
+    def defer(self, fn, *args, **kwargs):
+        # like submit, but returns a Future of the result
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(fn(*args, **kwargs))
+
+            except Exception as e:
+                future.set_exception(e)
+
+        self.submit(run)
+
+        return future
+
+    def call_later(self, delay, fn, *args, **kwargs):
+        timer = Timer(time.time() + delay, fn, args, kwargs)
+
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("Runtime stopped")
+
+            heapq.heappush(self._timers, (timer.deadline, self._seq.next(), timer))
+
+            self._spawn()
+            self._cond.notify()
+
+        return timer
+
+    def _next_task(self):
+        # caller holds the condition
+        while True:
+            if self._stopped:
+                return None
+
+            now = time.time()
+
+            while len(self._timers) > 0 and self._timers[0][0] <= now:
+                timer = heapq.heappop(self._timers)[2]
+
+                if not timer.cancelled:
+                    self._ready.append((timer.fn, timer.args, timer.kwargs))
+
+            if len(self._ready) > 0:
+                return self._ready.popleft()
+
+            if len(self._timers) > 0:
+                timeout = self._timers[0][0] - now
+
+            else:
+                timeout = None
+
+            self._idle += 1
+            self._cond.wait(timeout)
+            self._idle -= 1
+
+    def _work(self):
+        while True:
+            with self._cond:
+                task = self._next_task()
+
+            if task is None:
+                return
+
+            fn, args, kwargs = task
+
+            try:
+                fn(*args, **kwargs)
+
+            except Exception as e:
+                logging.exception("Runtime task %s raised exception: %s", fn, str(e))
+
+            self.tasks_run += 1
+
+    def stats(self):
+        with self._cond:
+            return {"workers": len(self._workers),
+                    "idle": self._idle,
+                    "ready": len(self._ready),
+                    "timers": len(self._timers),
+                    "tasks_run": self.tasks_run}
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._ready.clear()
+            self._timers = list()
+
+            self._cond.notify_all()
+
+    def join(self, timeout=None):
+        for worker in list(self._workers):
+            worker.join(timeout)
+
+
+class Mailbox(object):
+    # runs handler on posted items one at a time and in order, on the
+    # runtime. an empty or paused mailbox holds no worker.
+    def __init__(self, handler, runtime=None, batch_size=64):
+        super(Mailbox, self).__init__()
+
+        self._handler = handler
+        self._runtime = runtime
+        self._batch_size = batch_size
+
+        self._lock = threading.Lock()
+        self._items = collections.deque()
+        self._scheduled = False
+        self._paused = False
+
+    def __len__(self):
+        return len(self._items)
+
+    def _schedule(self):
+        # caller holds the lock
+        if self._scheduled or self._paused or len(self._items) == 0:
+            return False
+
+        self._scheduled = True
+
+        return True
+
+    def _submit(self):
+        runtime = self._runtime or get_runtime()
+        runtime.submit(self._drain)
+
+    def post(self, item):
+        with self._lock:
+            self._items.append(item)
+            schedule = self._schedule()
+
+        if schedule:
+            self._submit()
+
+    def pause(self):
+        with self._lock:
+            self._paused = True
+
+    def resume(self):
+        with self._lock:
+            self._paused = False
+            schedule = self._schedule()
+
+        if schedule:
+            self._submit()
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def _drain(self):
+        # runs a batch, then goes to the back of the runtime queue so
+        # busy mailboxes don't starve the others
+        for i in xrange(self._batch_size):
+            with self._lock:
+                if self._paused or len(self._items) == 0:
+                    self._scheduled = False
+                    return
+
+                item = self._items.popleft()
+
+            try:
+                self._handler(item)
+
+            except Exception as e:
+                logging.exception("Mailbox handler %s raised exception: %s", self._handler, str(e))
+
+        with self._lock:
+            self._scheduled = False
+            schedule = self._schedule()
+
+        if schedule:
+            self._submit()
+
+
+_runtime = None
+_runtime_lock = threading.Lock()
+
+
+def get_runtime():
+    global _runtime
+
+    if _runtime is None:
+        with _runtime_lock:
+            if _runtime is None:
+                _runtime = Runtime()
+
+    return _runtime
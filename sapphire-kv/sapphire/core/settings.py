@@ -42,6 +42,20 @@ LOG_PATH = get_app_dir()
 LOG_LEVEL = "info"
 OBJECT_TIME_TO_LIVE = 60
 OBJECT_PUBLISH_RATE = 4
+OBJECT_ANTI_ENTROPY = True
+PUBLISH_BATCH_SIZE = 256
+PUBLISH_BATCH_WINDOW = 0.0
+WIRE_CODEC = "json"
+OBJECT_CHANNEL_ROUTING = True
+OBJECT_CHANNEL_SHARDS = 1
+EVENT_WORKERS = 10
+RUNTIME_WORKERS = 32
+SHARED_RUNTIME = False
+MANAGER_RUNTIME_WORKERS = 4
+OBJECT_SNAPSHOT = False
+OBJECT_SNAPSHOT_PATH = get_app_dir()
+OBJECT_SNAPSHOT_FILENAME = os.path.splitext(os.path.split(sys.argv[0])[1])[0] + "_objects.db"
+OBJECT_SNAPSHOT_INTERVAL = 2.0
 
 
 ###################
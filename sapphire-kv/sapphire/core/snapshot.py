@@ -0,0 +1,137 @@
+#
+# <license>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+# 
+# 
+# Copyright 2013 Sapphire Open Systems
+#  
+# </license>
+#
+
+import logging
+import threading
+
+from store import Store
+from runtime import get_runtime
+import settings
+
+
+class RegistrySnapshot(object):
+    # local copy of the remote objects in the registry, so a restart
+    # starts from the last known state instead of asking every node
+    # to republish. changed objects are marked dirty and written in
+    # one transaction every OBJECT_SNAPSHOT_INTERVAL.
+    def __init__(self, db_path=None, db_name=None, runtime=None):
+        super(RegistrySnapshot, self).__init__()
+
+        if db_path is None:
+            db_path = settings.OBJECT_SNAPSHOT_PATH
+
+        if db_name is None:
+            db_name = settings.OBJECT_SNAPSHOT_FILENAME
+
+        self.store = Store(db_path=db_path, db_name=db_name)
+
+        # object_id -> object to write, or None to delete
+        self._lock = threading.Lock()
+        self._dirty = dict()
+
+        # held by the timer and close(), so a flush can't run on a
+        # closed store
+        self._timer_lock = threading.Lock()
+
+        self._runtime = runtime
+        self._timer = None
+        self._closed = False
+
+        # counters
+        self.written = 0
+        self.deleted = 0
+
+    def load(self):
+        # returns the saved objects as dicts
+        return [value.to_dict() for key, value in self.store.query(all=True)]
+
+    def mark(self, obj):
+        with self._lock:
+            self._dirty[obj.object_id] = obj
+
+    def mark_removed(self, object_id):
+        with self._lock:
+            self._dirty[object_id] = None
+
+    def start(self):
+        self._schedule()
+
+    def _schedule(self):
+        self._timer = (self._runtime or get_runtime()).call_later(settings.OBJECT_SNAPSHOT_INTERVAL, self._run_timer)
+
+    def _run_timer(self):
+        with self._timer_lock:
+            if self._closed:
+                return
+
+            try:
+                self.flush()
+
+            except Exception as e:
+                logging.exception("RegistrySnapshot unexpected exception: %s", str(e))
+
+            self._schedule()
+
+    def flush(self):
+        with self._lock:
+            dirty = self._dirty
+            self._dirty = dict()
+
+        if len(dirty) == 0:
+            return
+
+        updates = list()
+        removed = list()
+
+        for object_id, obj in dirty.iteritems():
+            if obj is None:
+                removed.append(object_id)
+
+            else:
+                # the saved updated_at must match the attributes
+                with obj._lock:
+                    updates.append((object_id, obj.to_dict()))
+
+        try:
+            with self.store.transaction():
+                self.store.update_many(updates)
+
+                for object_id in removed:
+                    try:
+                        del self.store[object_id]
+
+                    except KeyError:
+                        pass
+
+        except:
+            # try again on the next flush, unless marked again since
+            with self._lock:
+                dirty.update(self._dirty)
+                self._dirty = dirty
+
+            raise
+
+        self.written += len(updates)
+        self.deleted += len(removed)
+
+    def close(self):
+        with self._timer_lock:
+            if self._closed:
+                return
+
+            self._closed = True
+
+            if self._timer:
+                self._timer.cancel()
+
+            self.flush()
+            self.store.close()
@@ -16,10 +16,87 @@ import sqlite3
 import json
 import datetime
 import os
+import contextlib
+import collections
+import logging
+import time
+import re
+import threading
+import thread
+import weakref
 
 from sapphire.core import queryable
 from sapphire.core.settings import get_app_dir
+from sapphire.core.runtime import get_runtime
 
+# sqlite's default limit is 999 parameters per statement
+_MAX_PARAMS = 500
+
+# marks a buffered delete
+_DELETED = object()
+
+# rows fetched at a time by query()
+_QUERY_FETCH_SIZE = 256
+
+# range of sqlite integers
+_MIN_INT = -2 ** 63
+_MAX_INT = 2 ** 63 - 1
+
+# fields that can go into a JSON path and an index name as they are
+_FIELD = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def _json_field(field):
+    # must be the same expression in create_index() and query() for
+    # sqlite to use the index
+    return "json_extract(value, '$.%s')" % (field)
+
+def _match_values(value):
+    # query_dict compares str() of values. returns the values that
+    # json_extract can return for a match, and whether it can be
+    # NULL, or None if they can't be worked out.
+    if isinstance(value, basestring):
+        s = value
+
+    elif isinstance(value, (bool, int, long)) or value is None:
+        s = str(value)
+
+    else:
+        return None
+
+    # str() of lists and dicts doesn't match their JSON
+    if s.startswith("[") or s.startswith("{"):
+        return None
+
+    values = [s]
+
+    try:
+        i = int(s)
+
+        # sqlite reads larger integers as floats, and can't bind them
+        if not _MIN_INT <= i <= _MAX_INT:
+            return None
+
+        values.append(i)
+
+    except ValueError:
+        try:
+            # str() of a float rounds to 12 digits, so the stored
+            # value can differ
+            float(s)
+            return None
+
+        except ValueError:
+            pass
+
+    # JSON booleans come back as integers
+    if s == "True":
+        values.append(1)
+
+    elif s == "False":
+        values.append(0)
+
+    return values, s == "None"
 
 
 class StoreJsonEncoder(json.JSONEncoder):
@@ -58,64 +135,562 @@ class StoreDict(DictMixin):
         return None
 
 
+class _Reader(object):
+    # a thread's reader connection. only the thread's locals refer to
+    # it, so it is released when the thread exits.
+    def __init__(self, conn):
+        super(_Reader, self).__init__()
+
+        self.conn = conn
+
+
 class Store(DictMixin):
-    def __init__(self, db_path=get_app_dir(), db_name=None):
+    # safe to use from any number of threads. reads go through a
+    # connection per thread and run concurrently under the write
+    # ahead log. writes are serialized on a single writer connection.
+    #
+    # cache_size keeps that many decoded values in an LRU. values from
+    # the cache are shared between readers, write them back to the
+    # store instead of changing them in place.
+    #
+    # write_buffer_size > 0 holds writes and deletes in memory, only
+    # the last write to a key is kept. they are written in one
+    # transaction when the buffer is full, when the oldest is
+    # flush_interval seconds old, on flush() and on close().
+    def __init__(self, db_path=get_app_dir(), db_name=None, 
+                 cache_size=0, write_buffer_size=0, flush_interval=1.0):
         self.db_name = db_name
         self.db_path = db_path
         self.db_file = os.path.join(db_path, db_name)
 
-        self.conn = sqlite3.connect(self.db_file)
+        self.cache_size = cache_size
+        self.write_buffer_size = write_buffer_size
+        self.flush_interval = flush_interval
+
+        # held for every write, and for the whole of a transaction
+        self._write_lock = threading.RLock()
+
+        # guards the cache, counters and readers, never held while
+        # acquiring another lock
+        self._lock = threading.Lock()
+
+        self._cache = collections.OrderedDict()
+
+        # bumped on every invalidation, a value read from the database
+        # is only cached if nothing was written meanwhile
+        self._generation = 0
+
+        # key -> encoded value or _DELETED
+        self._buffer = dict()
+        self._buffer_since = None
+
+        # flushes the buffer flush_interval after the first write
+        # into it, so an idle store doesn't hold on to writes
+        self._flush_timer = None
+
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+
+        # transactions are managed by transaction(), statements
+        # outside of one commit on their own
+        self.conn = sqlite3.connect(self.db_file, isolation_level=None, check_same_thread=False)
         self.c = self.conn.cursor()
 
-        self.c.execute('''CREATE TABLE IF NOT EXISTS kv_data (key, value)''')
+        # reader connection per thread, closed when the thread exits.
+        # weakref to the thread's _Reader -> connection.
+        self._local = threading.local()
+        self._readers = dict()
+
+        # nesting depth of transaction(), the thread in it, and the
+        # keys written in it
+        self._depth = 0
+        self._owner = None
+        self._tx_keys = set()
+
+        # with a write ahead log, readers don't block the writer and
+        # a commit only appends to the log. synchronous=NORMAL skips
+        # the fsync per commit, a power loss can lose the last commits
+        # but never corrupts the database.
+        self.c.execute('''PRAGMA journal_mode=WAL''')
+        self.c.execute('''PRAGMA synchronous=NORMAL''')
+
+        with self.transaction():
+            self._create_table()
+
+        # without the JSON functions, query() checks every row
+        try:
+            self.c.execute('''SELECT json_extract('{}', '$.a')''')
+            self._json = True
+
+        except sqlite3.OperationalError:
+            self._json = False
+
+    def _create_table(self):
+        # columns are (cid, name, type, notnull, default, pk)
+        self.c.execute('''PRAGMA table_info(kv_data)''')
+        columns = self.c.fetchall()
+
+        if len(columns) == 0:
+            self.c.execute('''CREATE TABLE kv_data (key PRIMARY KEY, value)''')
+
+        elif not any([column[5] for column in columns]):
+            # table from before keys were unique, the last row written
+            # for a key wins
+            logging.info("Store: migrating %s" % (self.db_file))
+
+            self.c.execute('''CREATE TABLE kv_data_new (key PRIMARY KEY, value)''')
+            self.c.execute('''INSERT OR REPLACE INTO kv_data_new 
+                              SELECT key, value FROM kv_data ORDER BY rowid''')
+            self.c.execute('''DROP TABLE kv_data''')
+            self.c.execute('''ALTER TABLE kv_data_new RENAME TO kv_data''')
+
+    def _in_transaction(self):
+        # whether the calling thread is in a transaction
+        return self._owner is not None and self._owner == thread.get_ident()
+
+    def _reader(self):
+        # a thread in a transaction reads its own writes
+        if self._in_transaction():
+            return self.conn
+
+        reader = getattr(self._local, "reader", None)
+
+        if reader is None:
+            reader = _Reader(sqlite3.connect(self.db_file, isolation_level=None, check_same_thread=False))
+
+            self._local.reader = reader
+
+            with self._lock:
+                self._readers[weakref.ref(reader, self._reader_released)] = reader.conn
+
+        return reader.conn
+
+    def _reader_released(self, ref):
+        # called when a thread with a reader connection exits
+        with self._lock:
+            conn = self._readers.pop(ref, None)
+
+        if conn is not None:
+            conn.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # commits all writes in the block at once, or none of them if
+        # it raises. nested transactions join the outermost one.
+        # writes in a transaction are not buffered, and other threads
+        # wait to write until it ends.
+        with self._write_lock:
+            if self._depth == 0:
+                self.flush()
+
+            with self._transaction():
+                yield self
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # caller holds the write lock
+        if self._depth == 0:
+            self.c.execute('''BEGIN IMMEDIATE''')
+            self._owner = thread.get_ident()
+
+        self._depth += 1
+
+        try:
+            yield
+
+        except:
+            self._depth -= 1
+
+            if self._depth == 0:
+                self._end_transaction('''ROLLBACK''')
+
+            raise
+
+        self._depth -= 1
+
+        if self._depth == 0:
+            self._end_transaction('''COMMIT''')
+
+    def _end_transaction(self, statement):
+        try:
+            self.c.execute(statement)
+
+        finally:
+            self._owner = None
+
+            keys = self._tx_keys
+            self._tx_keys = set()
+
+            self._invalidate(keys)
+
+    def _written(self, keys):
+        # caller holds the write lock. cached values are dropped once
+        # the write is visible to other threads.
+        if self._depth > 0:
+            self._tx_keys.update(keys)
+
+        else:
+            self._invalidate(keys)
+
+    def _invalidate(self, keys):
+        with self._lock:
+            self._generation += 1
+
+            for key in keys:
+                self._cache.pop(key, None)
+
+    def _cache_get(self, key):
+        # returns (value or None, generation). the cache holds
+        # committed values, a thread in a transaction reads around it.
+        if self.cache_size <= 0 or self._in_transaction():
+            self.misses += 1
+
+            return None, None
 
-        self.commit()
+        with self._lock:
+            value = self._cache.pop(key, None)
+
+            if value is not None:
+                self._cache[key] = value
+                self.hits += 1
+
+            else:
+                self.misses += 1
+
+            return value, self._generation
+
+    def _cache_put(self, key, value, generation):
+        # values read in a transaction may yet be rolled back
+        if self.cache_size <= 0 or self._in_transaction():
+            return
+
+        with self._lock:
+            if generation != self._generation:
+                return
+
+            self._cache[key] = value
+
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
 
     def commit(self):
-        self.conn.commit()
+        with self._write_lock:
+            self.conn.commit()
+
+    def flush(self):
+        # writes out buffered writes and deletes. readers call this
+        # on every query, so don't wait for the writer when there is
+        # nothing to write.
+        if len(self._buffer) == 0:
+            return
+
+        with self._write_lock:
+            if len(self._buffer) == 0:
+                return
+
+            # the buffer stays visible to readers until committed
+            with self._transaction():
+                self.c.executemany('''INSERT OR REPLACE INTO kv_data VALUES (?,?)''', 
+                                   [(key, value) for key, value in self._buffer.iteritems() 
+                                    if value is not _DELETED])
+
+                self.c.executemany('''DELETE FROM kv_data WHERE key=?''', 
+                                   [(key,) for key, value in self._buffer.iteritems() 
+                                    if value is _DELETED])
+
+            self._buffer = dict()
+            self._buffer_since = None
+
+            self._cancel_flush_timer()
+
+            self.flushes += 1
+
+    def _cancel_flush_timer(self):
+        # caller holds the write lock
+        if self._flush_timer:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+    def _check_flush(self):
+        if self._buffer_since is not None and \
+           (len(self._buffer) >= self.write_buffer_size or 
+            time.time() - self._buffer_since >= self.flush_interval):
+            self.flush()
+
+    def _buffer_write(self, key, value):
+        # caller holds the write lock
+        if self._buffer_since is None:
+            self._buffer_since = time.time()
+
+            self._flush_timer = get_runtime().call_later(self.flush_interval, self.flush)
+
+        self._buffer[key] = value
+
+        self._check_flush()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "flushes": self.flushes,
+                    "cached": len(self._cache),
+                    "buffered": len(self._buffer),
+                    "readers": len(self._readers)}
+
+    def create_index(self, field):
+        # expression index on a top level field of the values, for
+        # query() on that field
+        if not self._json or not _FIELD.match(field):
+            raise ValueError("Cannot index field: %s" % (field))
+
+        # index names are case insensitive, field names are not
+        with self._write_lock:
+            self.c.execute('''CREATE INDEX IF NOT EXISTS kv_data_%s ON kv_data (%s)''' % 
+                           (field.encode("hex"), _json_field(field)))
+
+    def drop_index(self, field):
+        if not _FIELD.match(field):
+            raise ValueError("Cannot index field: %s" % (field))
+
+        with self._write_lock:
+            self.c.execute('''DROP INDEX IF EXISTS kv_data_%s''' % (field.encode("hex")))
+
+    def query(self, **kwargs):
+        # generator of (key, StoreDict) for the values that
+        # queryable.query_dict matches. comparisons on fields that
+        # are identifiers are done in SQL to select candidate rows,
+        # each row is then checked with query_dict.
+        criteria = dict(kwargs)
+
+        match_all = criteria.pop("all", False)
+        contains = criteria.pop("contains", [])
+        criteria.pop("expr", None)
+
+        # query_dict needs at least one comparison
+        if not match_all and len(criteria) == 0:
+            return
+
+        if isinstance(contains, basestring):
+            contains = [contains]
+
+        conditions = list()
+        params = list()
+
+        if self._json and not match_all:
+            for field in contains:
+                if _FIELD.match(field):
+                    conditions.append("json_type(value, '$.%s') IS NOT NULL" % (field))
+
+            for field, value in criteria.iteritems():
+                match = _match_values(value)
+
+                if not _FIELD.match(field) or match is None:
+                    continue
+
+                values, null = match
+
+                condition = "%s IN (%s)" % (_json_field(field), ",".join(["?"] * len(values)))
+
+                if null:
+                    condition = "(%s OR %s IS NULL)" % (condition, _json_field(field))
+
+                conditions.append(condition)
+                params.extend(values)
+
+        sql = '''SELECT key, value FROM kv_data'''
+
+        if len(conditions) > 0:
+            sql += " WHERE " + " AND ".join(conditions)
+
+        self.flush()
+
+        # a cursor of our own, so the store can be used while the
+        # results are read
+        c = self._reader().cursor()
+        c.execute(sql, params)
+
+        try:
+            while True:
+                rows = c.fetchmany(_QUERY_FETCH_SIZE)
+
+                if len(rows) == 0:
+                    break
+
+                for key, value in rows:
+                    data = json.loads(value)
+
+                    if queryable.query_dict(data, **kwargs) is not None:
+                        yield key, StoreDict(data)
+
+        finally:
+            c.close()
 
     def keys(self):
-        self.c.execute('''SELECT key FROM kv_data''')
+        self.flush()
 
-        return [key[0] for key in self.c.fetchall()]
+        return [key[0] for key in self._reader().execute('''SELECT key FROM kv_data''')]
 
     def __len__(self):
-        self.c.execute('''SELECT COUNT(*) FROM kv_data''')
+        self.flush()
+
+        return self._reader().execute('''SELECT COUNT(*) FROM kv_data''').fetchone()[0]
+
+    def __contains__(self, key):
+        if not self._in_transaction():
+            with self._lock:
+                if key in self._cache:
+                    return True
+
+        data = self._buffer.get(key)
 
-        return self.c.fetchone()[0]
+        if data is not None:
+            return data is not _DELETED
+
+        row = self._reader().execute('''SELECT 1 FROM kv_data WHERE key=?''', (key,)).fetchone()
+
+        return row is not None
+
+    has_key = __contains__
 
     def __getitem__(self, key):
-        self.c.execute('''SELECT value FROM kv_data WHERE key=?''', (key,))
+        self._check_flush()
+
+        value, generation = self._cache_get(key)
 
-        value = self.c.fetchone()
+        if value is not None:
+            return value
 
-        if value == None:
+        data = self._buffer.get(key)
+
+        if data is _DELETED:
             raise KeyError
 
-        return StoreDict(json.loads(value[0]))
+        if data is None:
+            row = self._reader().execute('''SELECT value FROM kv_data WHERE key=?''', (key,)).fetchone()
+
+            if row == None:
+                raise KeyError
+
+            data = row[0]
+
+        value = StoreDict(json.loads(data))
+
+        self._cache_put(key, value, generation)
+
+        return value
+
+    def get_many(self, keys):
+        # returns a dict of the keys that exist
+        self._check_flush()
+
+        values = dict()
+        missing = list()
+
+        for key in keys:
+            value, generation = self._cache_get(key)
+
+            if value is not None:
+                values[key] = value
+                continue
+
+            data = self._buffer.get(key)
+
+            if data is None:
+                missing.append(key)
+
+            elif data is not _DELETED:
+                values[key] = StoreDict(json.loads(data))
+                self._cache_put(key, values[key], generation)
+
+        conn = self._reader()
+
+        # stay below the limit on parameters per statement
+        for i in xrange(0, len(missing), _MAX_PARAMS):
+            chunk = missing[i:i + _MAX_PARAMS]
+
+            with self._lock:
+                generation = self._generation
+
+            rows = conn.execute('''SELECT key, value FROM kv_data WHERE key IN (%s)''' % 
+                                (",".join(["?"] * len(chunk))), chunk)
+
+            for key, value in rows:
+                values[key] = StoreDict(json.loads(value))
+                self._cache_put(key, values[key], generation)
+
+        return values
 
     def __setitem__(self, key, value):
-        self.c.execute('''SELECT value FROM kv_data WHERE key=?''', (key,))
+        value = StoreJsonEncoder().encode(value)
 
-        if not self.c.fetchone():
-            self.c.execute('''INSERT INTO kv_data VALUES (?,?)''', (key, StoreJsonEncoder().encode(value),))
+        with self._write_lock:
+            if self.write_buffer_size > 0 and self._depth == 0:
+                self._buffer_write(key, value)
 
-        else:
-            self.c.execute('''UPDATE kv_data SET value=? WHERE key=?''', (StoreJsonEncoder().encode(value), key,))
+            else:
+                self.c.execute('''INSERT OR REPLACE INTO kv_data VALUES (?,?)''', (key, value,))
+
+            self._written([key])
+
+    def update_many(self, items):
+        # writes a dict or (key, value) pairs in one transaction
+        if hasattr(items, "iteritems"):
+            items = items.iteritems()
+
+        encoder = StoreJsonEncoder()
 
-        self.commit()
+        rows = [(key, encoder.encode(value)) for key, value in items]
+
+        with self.transaction():
+            self.c.executemany('''INSERT OR REPLACE INTO kv_data VALUES (?,?)''', rows)
+
+            self._written([key for key, value in rows])
 
     def __delitem__(self, key):
-        value = self[key] # raises KeyError if key does not exist
+        with self._write_lock:
+            if self.write_buffer_size > 0 and self._depth == 0:
+                if key not in self:
+                    raise KeyError
 
-        self.c.execute('''DELETE FROM kv_data WHERE key=?''', (key,))
-        self.commit()
+                self._buffer_write(key, _DELETED)
 
-    def delete(self):
-        os.remove(self.db_file)
+            else:
+                self.c.execute('''DELETE FROM kv_data WHERE key=?''', (key,))
 
+                if self.c.rowcount == 0:
+                    raise KeyError
 
+            self._written([key])
 
+    def close(self):
+        self.flush()
 
+        with self._write_lock:
+            self.conn.close()
 
+        with self._lock:
+            for conn in self._readers.values():
+                conn.close()
+
+            self._readers.clear()
+
+    def delete(self):
+        with self._write_lock:
+            self._buffer = dict()
+            self._buffer_since = None
+
+            self._cancel_flush_timer()
+
+        with self._lock:
+            self._generation += 1
+            self._cache.clear()
+
+        self.close()
+
+        os.remove(self.db_file)
 
+        # write ahead log and its index
+        for suffix in ["-wal", "-shm"]:
+            if os.path.exists(self.db_file + suffix):
+                os.remove(self.db_file + suffix)
@@ -0,0 +1,309 @@
+#
+# <license>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+# 
+# 
+# Copyright 2013 Sapphire Open Systems
+#  
+# </license>
+#
+
+import threading
+import logging
+
+from index import index_key
+
+
+def _criteria_key(criteria):
+    # identical queries share a view. expressions can only be
+    # compared by identity.
+    items = list()
+
+    for k, v in criteria.iteritems():
+        if k == "expr":
+            v = id(v)
+
+        elif k == "contains":
+            if isinstance(v, basestring):
+                v = [v]
+
+            v = tuple(sorted([index_key(a) for a in v]))
+
+        else:
+            v = index_key(v)
+
+        items.append((k, v))
+
+    return tuple(sorted(items))
+
+
+class QueryView(object):
+    # set of object ids matching a query, maintained incrementally as
+    # objects are added, change or are removed
+    def __init__(self, criteria, objects):
+        super(QueryView, self).__init__()
+
+        self.criteria = criteria
+        self._objects = objects
+        self.match_all = bool(criteria.get("all"))
+
+        self.object_ids = set()
+        self.subscriptions = set()
+        self.refs = 0
+
+        # attributes whose changes can alter membership, None for any
+        if self.match_all:
+            self.attrs = set()
+
+        elif "expr" in criteria:
+            self.attrs = None
+
+        else:
+            self.attrs = set([k for k in criteria if k not in ["all", "contains"]])
+
+            contains = criteria.get("contains", [])
+
+            if isinstance(contains, basestring):
+                contains = [contains]
+
+            self.attrs.update(contains)
+
+    def __contains__(self, object_id):
+        return object_id in self.object_ids
+
+    def __len__(self):
+        return len(self.object_ids)
+
+    def __str__(self):
+        return "QueryView: %s (%d objects)" % (self.criteria, len(self.object_ids))
+
+    def matches(self, obj):
+        return obj.query(**self.criteria) is not None
+
+    def objects(self):
+        objects = [self._objects.get(object_id) for object_id in list(self.object_ids)]
+
+        return [o for o in objects if o is not None]
+
+
+class Subscription(object):
+    # interest in events with the given keys (None for any key) on
+    # the objects in a view
+    def __init__(self, view, keys, callback):
+        super(Subscription, self).__init__()
+
+        self.view = view
+        self.keys = keys
+        self.callback = callback
+
+    def route_keys(self):
+        if self.keys is None:
+            return [None]
+
+        return self.keys
+
+
+class SubscriptionRegistry(object):
+    def __init__(self, objects):
+        super(SubscriptionRegistry, self).__init__()
+
+        # the object registry, object_id -> object
+        self._objects = objects
+
+        # never held while calling out to subscribers
+        self._lock = threading.RLock()
+
+        self._views = dict()
+
+        # attribute -> views depending on it
+        self._views_by_attr = dict()
+
+        # views that depend on any attribute
+        self._expr_views = set()
+
+        # (object_id, key) -> subscriptions. a key of None matches
+        # any key, an object_id of None is used by views that match
+        # all objects, so they don't need a route per object.
+        self._routes = dict()
+
+    def __len__(self):
+        return len(self._views)
+
+    def _add_route(self, route, sub):
+        if route not in self._routes:
+            self._routes[route] = set()
+
+        self._routes[route].add(sub)
+
+    def _remove_route(self, route, sub):
+        subs = self._routes.get(route)
+
+        if subs is None:
+            return
+
+        subs.discard(sub)
+
+        if len(subs) == 0:
+            del self._routes[route]
+
+    def _add_member(self, view, object_id):
+        view.object_ids.add(object_id)
+
+        if view.match_all:
+            return
+
+        for sub in view.subscriptions:
+            for key in sub.route_keys():
+                self._add_route((object_id, key), sub)
+
+    def _remove_member(self, view, object_id):
+        view.object_ids.discard(object_id)
+
+        if view.match_all:
+            return
+
+        for sub in view.subscriptions:
+            for key in sub.route_keys():
+                self._remove_route((object_id, key), sub)
+
+    def get_view(self, criteria):
+        key = _criteria_key(criteria)
+
+        with self._lock:
+            view = self._views.get(key)
+
+            if view is None:
+                view = QueryView(dict(criteria), self._objects)
+
+                for obj in self._objects.values():
+                    if view.matches(obj):
+                        view.object_ids.add(obj.object_id)
+
+                self._views[key] = view
+
+                if view.attrs is None:
+                    self._expr_views.add(view)
+
+                else:
+                    for attr in view.attrs:
+                        if attr not in self._views_by_attr:
+                            self._views_by_attr[attr] = set()
+
+                        self._views_by_attr[attr].add(view)
+
+            view.refs += 1
+
+            return view
+
+    def release_view(self, view):
+        with self._lock:
+            view.refs -= 1
+
+            if view.refs > 0:
+                return
+
+            del self._views[_criteria_key(view.criteria)]
+
+            self._expr_views.discard(view)
+
+            for attr in view.attrs or []:
+                views = self._views_by_attr[attr]
+                views.discard(view)
+
+                if len(views) == 0:
+                    del self._views_by_attr[attr]
+
+    def subscribe(self, criteria, keys, callback):
+        with self._lock:
+            view = self.get_view(criteria)
+
+            sub = Subscription(view, keys, callback)
+            view.subscriptions.add(sub)
+
+            if view.match_all:
+                for key in sub.route_keys():
+                    self._add_route((None, key), sub)
+
+            else:
+                for object_id in view.object_ids:
+                    for key in sub.route_keys():
+                        self._add_route((object_id, key), sub)
+
+            return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            view = sub.view
+
+            if sub not in view.subscriptions:
+                return
+
+            if view.match_all:
+                for key in sub.route_keys():
+                    self._remove_route((None, key), sub)
+
+            else:
+                for object_id in view.object_ids:
+                    for key in sub.route_keys():
+                        self._remove_route((object_id, key), sub)
+
+            view.subscriptions.discard(sub)
+
+            self.release_view(view)
+
+    def object_added(self, obj):
+        with self._lock:
+            for view in self._views.itervalues():
+                if view.matches(obj):
+                    self._add_member(view, obj.object_id)
+
+    def object_removed(self, object_id):
+        with self._lock:
+            for view in self._views.itervalues():
+                if object_id in view.object_ids:
+                    self._remove_member(view, object_id)
+
+    def object_changed(self, obj, key):
+        with self._lock:
+            views = self._views_by_attr.get(key, set()) | self._expr_views
+
+            for view in views:
+                member = obj.object_id in view.object_ids
+                matches = view.matches(obj)
+
+                if matches and not member:
+                    self._add_member(view, obj.object_id)
+
+                elif member and not matches:
+                    self._remove_member(view, obj.object_id)
+
+    def match(self, event):
+        subs = set()
+
+        with self._lock:
+            # an object_id of None would collide with the wildcard routes
+            if event.object_id is not None:
+                for route in [(event.object_id, event.key), (event.object_id, None)]:
+                    subs.update(self._routes.get(route, []))
+
+            # views matching all objects still need the object to exist
+            for route in [(None, event.key), (None, None)]:
+                for sub in self._routes.get(route, []):
+                    if event.object_id in sub.view.object_ids:
+                        subs.add(sub)
+
+        return subs
+
+    def route(self, event):
+        # subscriptions without a callback are only used for matching
+        for sub in self.match(event):
+            if sub.callback is None:
+                continue
+
+            try:
+                sub.callback(event)
+
+            except Exception as e:
+                logging.exception("Subscription callback raised exception: %s", str(e))
@@ -0,0 +1,77 @@
+#
+# <license>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+# 
+# 
+# Copyright 2013 Sapphire Open Systems
+#  
+# </license>
+#
+
+import threading
+import time
+
+
+class VersionTable(object):
+    # change counters for objects, collections and the whole registry.
+    # every change takes the next global version, so versions never
+    # repeat, even for an object that is deleted and created again.
+    # they start over in every process.
+    def __init__(self):
+        super(VersionTable, self).__init__()
+
+        # never held while acquiring any other lock
+        self._lock = threading.Lock()
+
+        self._version = 0
+        self._modified = time.time()
+
+        # object_id -> (version, modified, collection key)
+        self._objects = dict()
+
+        # collection key -> (version, modified)
+        self._collections = dict()
+
+    def touch(self, object_id, collection):
+        with self._lock:
+            self._version += 1
+            self._modified = time.time()
+
+            previous = self._objects.get(object_id)
+
+            # moving between collections changes both
+            if previous is not None and previous[2] != collection:
+                self._collections[previous[2]] = (self._version, self._modified)
+
+            self._objects[object_id] = (self._version, self._modified, collection)
+            self._collections[collection] = (self._version, self._modified)
+
+    def remove(self, object_id):
+        with self._lock:
+            previous = self._objects.pop(object_id, None)
+
+            if previous is None:
+                return
+
+            self._version += 1
+            self._modified = time.time()
+
+            self._collections[previous[2]] = (self._version, self._modified)
+
+    def version(self):
+        # returns (version, modified)
+        return self._version, self._modified
+
+    def object_version(self, object_id):
+        # returns (version, modified) or None if the object is unknown
+        entry = self._objects.get(object_id)
+
+        if entry is None:
+            return None
+
+        return entry[0], entry[1]
+
+    def collection_version(self, collection):
+        return self._collections.get(collection)
@@ -31,7 +31,12 @@ setup(
         "redis >= 2.7.2",
         "pydispatcher >= 2.0.3",
         "paste >= 1.7.5.1",
-    ]
+    ],
+
+    extras_require={
+        "msgpack": ["msgpack >= 0.5.2"],
+        "gevent": ["gevent >= 1.0"],
+    }
 )
 
 